@@ -1,6 +1,10 @@
 __copyright__ = "Copyright (c) 2021 Jina AI Limited. All rights reserved."
 __license__ = "Apache-2.0"
 
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from typing import Optional, List, Union, Dict
 
 import numpy as np
@@ -10,6 +14,11 @@ from jina import Executor, requests, DocumentArray, Document
 from jina_commons import get_logger
 from jina_commons.indexers.dump import import_vectors
 
+_MANIFEST = 'manifest.json'
+_INDEX_FILE = 'index.ann'
+_IDS_FILE = 'ids.npy'
+_VECS_FILE = 'vecs.npy'
+
 
 class AnnoySearcher(Executor):
     """Annoy powered vector indexer
@@ -29,6 +38,14 @@ class AnnoySearcher(Executor):
             dump_path: Optional[str] = None,
             default_traversal_paths: List[str] = ['r'],
             is_distance: bool = False,
+            mmap: bool = True,
+            mmap_path: Optional[str] = None,
+            n_jobs: int = -1,
+            on_disk_build: bool = False,
+            search_k: int = -1,
+            num_query_threads: Optional[int] = None,
+            keep_vectors: bool = True,
+            rerank_factor: int = 1,
             **kwargs,
     ):
         """
@@ -40,6 +57,25 @@ class AnnoySearcher(Executor):
         :param dump_path: the path to load ids and vecs
         :param traverse_path: traverse path on docs, e.g. ['r'], ['c']
         :param is_distance: Boolean flag that describes if distance metric need to be reinterpreted as similarities.
+        :param mmap: if True, the built forest is saved with the ids and vectors of the dump, and memory-mapped on
+            later starts instead of being built again, as long as the dump, `metric` and `num_trees` have not
+            changed. Replicas on the same host then share its pages. If False, the forest is built on every start.
+        :param mmap_path: directory where the built forest is saved. Defaults to the workspace.
+        :param n_jobs: number of threads building the trees, -1 uses all the cores.
+        :param on_disk_build: if True, the forest is built directly into its file instead of in memory, and the
+            vectors of the dump are streamed into it. The file is the saved forest when `mmap` is on, or else
+            `index_{pea_id}.ann` in the workspace, next to the vectors memory-mapped in `vecs_{pea_id}.npy`.
+        :param search_k: number of nodes inspected by a query, -1 uses `top_k * num_trees`. Larger values give
+            higher precision and slower queries. Can be overridden per request, as `top_k`.
+        :param num_query_threads: number of threads the queries of a request are spread over. Annoy releases
+            the GIL while querying, so they run in parallel. Defaults to the number of cores plus 4.
+        :param keep_vectors: if False, no copy of the vectors is kept next to the forest. The embeddings of the
+            matches and of `/fill_embedding` are then read from the items of the forest, in float32. Searches can
+            also skip the embeddings of the matches with the `return_embeddings` parameter.
+        :param rerank_factor: if greater than 1, `rerank_factor * top_k` neighbours are fetched from the forest and
+            the `top_k` first are kept. With the default `search_k`, this inspects `rerank_factor` times more
+            candidates, which Annoy ranks by their exact distance, and gives the recall of a larger forest with
+            fewer trees. Can be overridden per request.
         :param args:
         :param kwargs:
         """
@@ -49,30 +85,147 @@ class AnnoySearcher(Executor):
         self.num_trees = num_trees
         self.default_traversal_paths = default_traversal_paths
         self.is_distance = is_distance
+        self.mmap = mmap
+        self.mmap_path = mmap_path
+        self.n_jobs = n_jobs
+        self.on_disk_build = on_disk_build
+        self.search_k = search_k
+        self.keep_vectors = keep_vectors
+        self.rerank_factor = rerank_factor
+        self._pool = ThreadPoolExecutor(max_workers=num_query_threads)
         self.logger = get_logger(self)
         dump_path = dump_path or kwargs.get('runtime_args', {}).get('dump_path', None)
         if dump_path is not None:
-            self.logger.info('Start building "AnnoyIndexer" from dump data')
-            ids, vecs = import_vectors(dump_path, str(self.metas.pea_id))
-            self._ids = np.array(list(ids))
-            self._vecs = np.array(list(vecs))
-            num_dim = self._vecs.shape[1]
-            self._indexer = AnnoyIndex(num_dim, self.metric)
-            self._doc_id_to_offset = {}
-            self._load_index(self._ids, self._vecs)
+            cache_dir = self._cache_dir()
+            if cache_dir is not None:
+                self._load_or_build(dump_path, cache_dir)
+            else:
+                index_path = self._on_disk_path()
+                vecs_path = None
+                if index_path is not None:
+                    # the vectors are memory-mapped next to the forest, so that neither has to fit in memory
+                    vecs_path = os.path.join(self.workspace, f'vecs_{self.metas.pea_id}.npy')
+                self._build_from_dump(dump_path, index_path, vecs_path)
         else:
             self.logger.warning(
                 'No data loaded in "AnnoyIndexer". Use .rolling_update() to re-initialize it...'
             )
 
+    def _cache_dir(self) -> Optional[str]:
+        root = self.mmap_path or self.workspace
+        if not self.mmap or root is None:
+            return None
+        return os.path.join(root, f'index_{self.metas.pea_id}')
+
+    def _on_disk_path(self) -> Optional[str]:
+        if not self.on_disk_build or self.workspace is None:
+            return None
+        os.makedirs(self.workspace, exist_ok=True)
+        return os.path.join(self.workspace, f'index_{self.metas.pea_id}.ann')
+
+    def _build_from_dump(
+        self, dump_path: str, index_path: Optional[str] = None, vecs_path: Optional[str] = None
+    ) -> bool:
+        """Build the forest in a single pass over the dump
+
+        The vectors are streamed into the forest, built in the file `index_path` if given, and into an
+        array, memory-mapped at `vecs_path` if given, unless `keep_vectors` is off.
+        """
+        self.logger.info('Start building "AnnoySearcher" from dump data')
+        ids, vecs = import_vectors(dump_path, str(self.metas.pea_id))
+        self._ids = np.array(list(ids))
+        first = next(vecs, None)
+        if first is None:
+            self.logger.warning('The dump is empty')
+            return False
+        shape = (len(self._ids), len(first))
+        if not self.keep_vectors:
+            self._vecs = None
+        elif vecs_path is None:
+            self._vecs = np.empty(shape, dtype=first.dtype)
+        else:
+            self._vecs = np.lib.format.open_memmap(
+                vecs_path, mode='w+', dtype=first.dtype, shape=shape
+            )
+
+        def _stored(rows):
+            for i, row in enumerate(rows):
+                if self._vecs is not None:
+                    self._vecs[i] = row
+                yield row
+
+        self._indexer = AnnoyIndex(len(first), self.metric)
+        if index_path is not None:
+            self._indexer.on_disk_build(index_path)
+        self._doc_id_to_offset = {}
+        self._load_index(self._ids, _stored(chain([first], vecs)))
+        return True
+
+    def _load_or_build(self, dump_path: str, cache_dir: str):
+        """Memory-map the forest saved on a previous start, or build it and save it to `cache_dir`
+
+        The manifest ties the saved forest to the dump and to the parameters it was built with.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest_path = os.path.join(cache_dir, _MANIFEST)
+        index_path = os.path.join(cache_dir, _INDEX_FILE)
+        vecs_path = os.path.join(cache_dir, _VECS_FILE)
+        manifest = {
+            'dump': _dump_fingerprint(dump_path, str(self.metas.pea_id)),
+            'index': {'metric': self.metric, 'num_trees': self.num_trees},
+        }
+        saved = _read_manifest(manifest_path)
+        if (
+            {key: saved.get(key) for key in manifest} == manifest
+            and 'num_dim' in saved
+            and os.path.exists(index_path)
+            and (not self.keep_vectors or os.path.exists(vecs_path))
+        ):
+            self.logger.info(f'Memory-mapping the forest saved in {cache_dir}')
+            self._ids = np.load(os.path.join(cache_dir, _IDS_FILE))
+            self._vecs = np.load(vecs_path, mmap_mode='r') if self.keep_vectors else None
+            self._indexer = AnnoyIndex(saved['num_dim'], self.metric)
+            # `load` memory-maps the file, its pages are shared by the processes loading it
+            self._indexer.load(index_path)
+            self._doc_id_to_offset = {v: i for i, v in enumerate(self._ids)}
+            return
+
+        tmp_path = _tmp_path(index_path)
+        tmp_vecs_path = _tmp_path(vecs_path)
+        if not self._build_from_dump(
+            dump_path, tmp_path if self.on_disk_build else None, tmp_vecs_path
+        ):
+            return
+        self.logger.info(f'Saving the built forest to {cache_dir}')
+        if not self.on_disk_build:
+            self._indexer.save(tmp_path)
+        # the forest stays mapped across the rename
+        os.replace(tmp_path, index_path)
+        _save_npy(os.path.join(cache_dir, _IDS_FILE), self._ids)
+        if self._vecs is not None:
+            self._vecs.flush()
+            del self._vecs
+            os.replace(tmp_vecs_path, vecs_path)
+            self._vecs = np.load(vecs_path, mmap_mode='r')
+        elif os.path.exists(vecs_path):
+            # the vectors saved by a previous build belong to another dump
+            os.remove(vecs_path)
+        _write_manifest(manifest_path, dict(manifest, num_dim=self._indexer.f))
+
     def _load_index(self, ids, vecs):
         for idx, v in enumerate(vecs):
             self._indexer.add_item(idx, v.astype(np.float32))
             self._doc_id_to_offset[ids[idx]] = idx
-        self._indexer.build(self.num_trees)
+        self._indexer.build(self.num_trees, self.n_jobs)
 
     @requests(on='/search')
     def search(self, docs: DocumentArray, parameters: Dict, **kwargs):
+        """Attach the `top_k` nearest items to the documents, querying them in parallel threads
+
+        :param docs: the documents to search with
+        :param parameters: can override `top_k`, `search_k`, `rerank_factor` and `traversal_paths`, and skip the embeddings
+            of the matches with `return_embeddings`
+        """
         if not hasattr(self, '_indexer'):
             self.logger.warning('Querying against an empty index')
             return
@@ -80,13 +233,25 @@ class AnnoySearcher(Executor):
         traversal_paths = parameters.get(
             'traversal_paths', self.default_traversal_paths
         )
+        top_k = int(parameters.get('top_k', self.default_top_k))
+        search_k = int(parameters.get('search_k', self.search_k))
+        return_embeddings = parameters.get('return_embeddings', True)
+        rerank_factor = int(parameters.get('rerank_factor', self.rerank_factor))
 
-        for doc in docs.traverse_flat(traversal_paths):
+        def _query(doc):
+            # the candidates are already sorted by their exact distance
             indices, dists = self._indexer.get_nns_by_vector(
-                doc.embedding, self.default_top_k, include_distances=True
+                doc.embedding, top_k * rerank_factor, search_k=search_k, include_distances=True
             )
-            for idx, dist in zip(indices, dists):
-                match = Document(id=self._ids[idx], embedding=self._vecs[idx])
+            return indices[:top_k], dists[:top_k]
+
+        query_docs = list(docs.traverse_flat(traversal_paths))
+        for doc, (indices, dists) in zip(query_docs, self._pool.map(_query, query_docs)):
+            embeddings = (
+                self._vecs_at(indices) if return_embeddings and indices else [None] * len(indices)
+            )
+            for idx, dist, embedding in zip(indices, dists, embeddings):
+                match = Document(id=self._ids[idx], embedding=embedding)
                 if self.is_distance:
                     if self.metric == 'dot':
                         match.scores[self.metric] = 1 - dist
@@ -101,9 +266,71 @@ class AnnoySearcher(Executor):
                         match.scores[self.metric] = 1 / (1 + dist)
                 doc.matches.append(match)
 
+    def close(self) -> None:
+        self._pool.shutdown()
+
     @requests(on='/fill_embedding')
     def fill_embedding(self, query_da: DocumentArray, **kwargs):
-        for doc in query_da:
-            doc.embedding = np.array(
-                self._indexer.get_item_vector(int(self._doc_id_to_offset[str(doc.id)]))
+        """Set the embeddings of the documents that are in the index, looked up as one batch
+
+        :param query_da: the documents whose embeddings are filled, by id
+        """
+        if not hasattr(self, '_indexer'):
+            return
+        known = [doc for doc in query_da if str(doc.id) in self._doc_id_to_offset]
+        if len(known) < len(query_da):
+            self.logger.warning(
+                f'{len(query_da) - len(known)} documents are not in the index'
             )
+        if not known:
+            return
+        offsets = np.array([self._doc_id_to_offset[str(doc.id)] for doc in known])
+        for doc, vec in zip(known, self._vecs_at(offsets)):
+            doc.embedding = vec
+
+    def _vecs_at(self, offsets) -> 'np.ndarray':
+        if self._vecs is not None:
+            return self._vecs[offsets]
+        return np.array(
+            [self._indexer.get_item_vector(int(offset)) for offset in offsets],
+            dtype=np.float32,
+        )
+
+
+def _file_fingerprint(path: str) -> List:
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _dump_fingerprint(dump_path: str, pea_id: str) -> Dict:
+    shard_path = os.path.join(dump_path, pea_id)
+    return {
+        name: _file_fingerprint(os.path.join(shard_path, name))
+        for name in ('ids', 'vectors')
+    }
+
+
+def _read_manifest(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _write_manifest(path: str, manifest: Dict):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_path, path)
+
+
+def _tmp_path(path: str) -> str:
+    # unique per process, so that replicas writing to the same directory do not clash
+    root, ext = os.path.splitext(path)
+    return f'{root}.{os.getpid()}.tmp{ext}'
+
+
+def _save_npy(path: str, array: 'np.ndarray'):
+    tmp_path = _tmp_path(path)
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
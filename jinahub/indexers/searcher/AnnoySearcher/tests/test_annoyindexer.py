@@ -91,3 +91,157 @@ def test_query_vector_empty(tmpdir):
     docs = DocumentArray([Document(embedding=np.random.random(7))])
     indexer.search(docs, {})
     assert len(docs[0].matches) == 0
+
+
+def test_persisted_index(tmpdir, monkeypatch):
+    metas = {'workspace': str(tmpdir), 'name': 'searcher', 'pea_id': 0, 'replica_id': 0}
+    query = np.random.random(7)
+
+    def _search(indexer):
+        docs = DocumentArray([Document(embedding=query)])
+        indexer.search(docs, {})
+        return docs[0].matches.get_attributes('id')
+
+    built = AnnoySearcher(dump_path=DUMP_PATH, default_top_k=TOP_K, metas=metas)
+    assert os.path.exists(os.path.join(built.workspace, 'index_0', 'index.ann'))
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('the forest should not be built again')
+
+    monkeypatch.setattr(AnnoySearcher, '_load_index', _fail)
+    loaded = AnnoySearcher(dump_path=DUMP_PATH, default_top_k=TOP_K, metas=metas)
+    assert _search(loaded) == _search(built)
+    da = DocumentArray([Document(id=0)])
+    loaded.fill_embedding(da)
+    assert list(da[0].embedding)
+
+    # a different number of trees invalidates the saved forest
+    with pytest.raises(AssertionError):
+        AnnoySearcher(dump_path=DUMP_PATH, num_trees=5, metas=metas)
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_on_disk_build(tmpdir, mmap):
+    metas = {'workspace': str(tmpdir), 'name': 'searcher', 'pea_id': 0, 'replica_id': 0}
+    indexer = AnnoySearcher(
+        dump_path=DUMP_PATH, default_top_k=TOP_K, mmap=mmap, on_disk_build=True, n_jobs=2, metas=metas
+    )
+    if mmap:
+        path = os.path.join(indexer.workspace, 'index_0', 'index.ann')
+    else:
+        path = os.path.join(indexer.workspace, 'index_0.ann')
+    assert os.path.getsize(path) > 0
+
+    ids, vecs = import_vectors(DUMP_PATH, str(0))
+    ids = np.array(list(ids))
+    vecs = np.array(list(vecs))
+    np.testing.assert_equal(indexer._vecs, vecs)
+    # the vectors are not held in memory either
+    assert isinstance(indexer._vecs, np.memmap)
+    docs = DocumentArray([Document(embedding=vecs[3])])
+    indexer.search(docs, {})
+    assert len(docs[0].matches) == TOP_K
+    assert docs[0].matches[0].id == ids[3]
+
+
+def test_search_parameters(tmpdir):
+    metas = {'workspace': str(tmpdir), 'name': 'searcher', 'pea_id': 0, 'replica_id': 0}
+    indexer = AnnoySearcher(dump_path=DUMP_PATH, default_top_k=TOP_K, num_query_threads=4, metas=metas)
+    queries = np.random.random([64, 7])
+
+    docs = DocumentArray([Document(embedding=q) for q in queries])
+    indexer.search(docs, {'top_k': 3, 'search_k': 1000})
+    for query, doc in zip(queries, docs):
+        assert len(doc.matches) == 3
+        # the batched queries return the same matches as a single one
+        expected = indexer._indexer.get_nns_by_vector(query, 3, search_k=1000)
+        assert doc.matches.get_attributes('id') == [indexer._ids[idx] for idx in expected]
+
+    docs = DocumentArray([Document(embedding=queries[0])])
+    indexer.search(docs, {})
+    assert len(docs[0].matches) == TOP_K
+    indexer.close()
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_without_vectors(tmpdir, mmap):
+    metas = {'workspace': str(tmpdir), 'name': 'searcher', 'pea_id': 0, 'replica_id': 0}
+    for _ in range(2):
+        # with mmap, the second time the forest saved by the first one is memory-mapped
+        indexer = AnnoySearcher(
+            dump_path=DUMP_PATH, default_top_k=TOP_K, mmap=mmap, keep_vectors=False, metas=metas
+        )
+        assert indexer._vecs is None
+
+    ids, vecs = import_vectors(DUMP_PATH, str(0))
+    ids = list(ids)
+    vecs = np.array(list(vecs))
+    docs = DocumentArray([Document(embedding=vecs[2])])
+    indexer.search(docs, {})
+    match = docs[0].matches[0]
+    assert match.id == ids[2]
+    np.testing.assert_allclose(match.embedding, vecs[2], rtol=1e-6)
+
+    docs = DocumentArray([Document(embedding=vecs[2])])
+    indexer.search(docs, {'return_embeddings': False})
+    assert docs[0].matches[0].embedding is None
+
+    da = DocumentArray([Document(id=ids[4]), Document(id='unknown'), Document(id=ids[1])])
+    indexer.fill_embedding(da)
+    np.testing.assert_allclose(da[0].embedding, vecs[4], rtol=1e-6)
+    assert da[1].embedding is None
+    np.testing.assert_allclose(da[2].embedding, vecs[1], rtol=1e-6)
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'angular', 'manhattan', 'dot'])
+def test_rerank(tmpdir, metric):
+    from jina_commons.indexers.dump import export_dump_streaming
+
+    num_dim = 16
+    vectors = np.random.random([2000, num_dim])
+    dump_path = os.path.join(tmpdir, 'dump')
+    export_dump_streaming(
+        dump_path,
+        1,
+        len(vectors),
+        zip(np.arange(len(vectors)).astype(str), vectors, [b'' for _ in range(len(vectors))]),
+    )
+    metas = {'workspace': str(tmpdir), 'name': 'searcher', 'pea_id': 0, 'replica_id': 0}
+    indexer = AnnoySearcher(
+        dump_path=dump_path, default_top_k=TOP_K, metric=metric, num_trees=10, rerank_factor=10,
+        is_distance=True, metas=metas,
+    )
+    queries = np.random.random([20, num_dim])
+    if metric == 'dot':
+        exact = -queries.dot(vectors.T)
+    elif metric == 'angular':
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries_normalized = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        exact = np.sqrt(np.maximum(2 - 2 * queries_normalized.dot(normalized.T), 0))
+    elif metric == 'manhattan':
+        exact = np.abs(vectors[None, :, :] - queries[:, None, :]).sum(axis=-1)
+    else:
+        exact = np.sqrt(((vectors[None, :, :] - queries[:, None, :]) ** 2).sum(axis=-1))
+    truth = np.argsort(exact, axis=1)[:, :TOP_K].astype(str)
+
+    def _recall(parameters):
+        docs = DocumentArray([Document(embedding=q) for q in queries])
+        indexer.search(docs, parameters)
+        recall = np.mean(
+            [len(set(doc.matches.get_attributes('id')) & set(row)) / TOP_K for doc, row in zip(docs, truth)]
+        )
+        return docs, recall
+
+    docs, reranked = _recall({})
+    _, approximate = _recall({'rerank_factor': 1})
+    assert reranked > approximate
+    if metric != 'dot':
+        assert reranked >= 0.9
+    for query_idx, doc in enumerate(docs):
+        assert len(doc.matches) == TOP_K
+        for match in doc.matches:
+            score = match.scores[metric].value
+            if metric == 'dot':
+                # reinterpreted as 1 - dot
+                score = score - 1
+            np.testing.assert_allclose(score, exact[query_idx, int(match.id)], rtol=1e-6, atol=1e-6)
@@ -2,7 +2,13 @@ __copyright__ = "Copyright (c) 2021 Jina AI Limited. All rights reserved."
 __license__ = "Apache-2.0"
 
 import gzip
-from typing import Optional, Dict, List
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Optional, Dict, List, Iterable, Union
 
 import numpy as np
 from jina import Executor, DocumentArray, requests, Document
@@ -10,6 +16,17 @@ from jina import Executor, DocumentArray, requests, Document
 from jina_commons import get_logger
 from jina_commons.indexers.dump import import_vectors
 
+_MANIFEST = 'manifest.json'
+_INDEX_FILE = 'index.faiss'
+_PARTITION_FILE = 'index_{}.faiss'
+_IDS_FILE = 'ids.npy'
+_VECS_FILE = 'vecs.npy'
+_TUNING_CHUNK_SIZE = 65536
+_DELTA_MIN_CAPACITY = 1024
+_BUILD_CHUNK_SIZE = 65536
+_GZIP_MAGIC = b'\x1f\x8b'
+_MAX_EF_SEARCH = 1024
+
 
 class FaissSearcher(Executor):
     """Faiss-powered vector indexer
@@ -31,7 +48,32 @@ class FaissSearcher(Executor):
     :param metric: 'l2' or 'inner_product' accepted. Determines which distances to optimize by FAISS. l2...smaller is better, inner_product...larger is better
     :param normalize: whether or not to normalize the vectors e.g. for the cosine similarity https://github.com/facebookresearch/faiss/wiki/MetricType-and-distances#how-can-i-index-vectors-for-cosine-similarity
     :param nprobe: Number of clusters to consider at search time.
+    :param ef_search: Size of the candidate list explored at search time by HNSW index keys. If None, the
+        Faiss default is kept.
+    :param recall_target: recall@k the `/tune` endpoint selects the fastest `nprobe` or `ef_search` for.
     :param is_distance: Boolean flag that describes if distance metric need to be reinterpreted as similarities.
+    :param mmap: if True, the built index is written with the ids and vectors of the dump, and memory-mapped on
+        later starts instead of being trained and built again, as long as the dump and the index configuration
+        have not changed. If False, the index is built from the dump on every start.
+    :param mmap_path: directory where the built index is written. Defaults to the workspace.
+    :param trained_index_path: path of a trained, empty index shared by all the shards, as written by the
+        `/train` endpoint or by `python -m jinahub.indexers.searcher.FaissSearcher.train`. If the file
+        exists, every shard loads it and only adds its own vectors, instead of training its own index.
+    :param keep_vectors: if False, no copy of the vectors is kept in memory next to the index. The embeddings of
+        the matches and of `/fill_embedding` are reconstructed from the index when it stores the vectors exactly
+        (Flat without `normalize`), or else read from a memory-mapped float32 file, which is written to the
+        workspace when `mmap` is off. Searches can also skip the embeddings of the matches with the
+        `return_embeddings` parameter.
+    :param num_partitions: number of sub-indexes the vectors are split into. The sub-indexes are copies of the
+        same trained index, searched in parallel threads, and their top-k are merged into the top-k of the
+        executor. This uses several cores for a single query batch without running more shards.
+    :param num_threads: number of OpenMP threads used by Faiss for the searches and builds of this executor. If
+        None, Faiss uses all the cores. If 'auto', the cores are shared fairly between the peas of the pod on the
+        host: their number divided by `shards * replicas`. With `num_partitions`, every sub-index gets an equal
+        part of them.
+    :param k_factor: if greater than 1, `k_factor * top_k` candidates are fetched from the index and reranked by
+        their exact distance to the stored vectors, which are memory-mapped when `mmap` is on. This recovers a
+        near-exact ranking with compressed index keys (PQ, SQ). Can be overridden per request.
 
     .. highlight:: python
     .. code-block:: python
@@ -61,11 +103,20 @@ class FaissSearcher(Executor):
         metric: str = 'l2',
         normalize: bool = False,
         nprobe: int = 1,
+        ef_search: Optional[int] = None,
+        recall_target: float = 0.95,
         dump_path: Optional[str] = None,
         default_traversal_paths: List[str] = ['r'],
         is_distance: bool = False,
         default_top_k: int = 5,
         on_gpu: bool = False,
+        mmap: bool = True,
+        mmap_path: Optional[str] = None,
+        trained_index_path: Optional[str] = None,
+        keep_vectors: bool = True,
+        num_partitions: int = 1,
+        k_factor: int = 1,
+        num_threads: Optional[Union[int, str]] = None,
         *args,
         **kwargs,
     ):
@@ -77,28 +128,217 @@ class FaissSearcher(Executor):
         self.metric = metric
         self.normalize = normalize
         self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.recall_target = recall_target
+        self.tuning_curve = []
+        self._lock = threading.RLock()
         self.on_gpu = on_gpu
+        self.mmap = mmap
+        self.mmap_path = mmap_path
+        self.trained_index_path = trained_index_path
+        self.keep_vectors = keep_vectors
+        self.num_partitions = max(1, num_partitions)
+        self.k_factor = k_factor
 
         self.default_top_k = default_top_k
         self.default_traversal_paths = default_traversal_paths
         self.is_distance = is_distance
 
         self.logger = get_logger(self)
+        self.num_threads = self._thread_budget(num_threads)
+        self._limit_threads()
+        self._pool = None
+        if self.num_partitions > 1:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.num_partitions,
+                initializer=_set_omp_threads,
+                initargs=(self.num_threads and max(1, self.num_threads // self.num_partitions),),
+            )
 
+        self._delta_ids = []
+        self._delta_vecs = None
+        self._delta_size = 0
+        self._num_deleted = 0
+        self._mmapped_index_paths = None
+        self._removable = None
+        self.num_dim = None
+        self.dtype = np.float32
         dump_path = dump_path or kwargs.get('runtime_args').get('dump_path')
         if dump_path is not None:
-            self.logger.info('Start building "AnnoyIndexer" from dump data')
-            ids, vecs = import_vectors(dump_path, str(self.runtime_args.pea_id))
-            self._ids = np.array(list(ids))
+            cache_dir = self._cache_dir()
+            if cache_dir is not None:
+                self._load_or_build(dump_path, cache_dir)
+            else:
+                self._build_from_dump(dump_path, self._vecs_file_path())
+            self._release_vectors()
             self._ext2int = {v: i for i, v in enumerate(self._ids)}
-            self._vecs = np.array(list(vecs))
-            self.num_dim = self._vecs.shape[1]
-            self.dtype = self._vecs.dtype
-            self.index = self._build_index(self._vecs)
         else:
             self.logger.warning(
-                'No data loaded in "AnnoyIndexer". Use .rolling_update() to re-initialize it...'
+                'No data loaded in "FaissSearcher". Use .rolling_update() to re-initialize it...'
+            )
+
+    def _thread_budget(self, num_threads: Optional[Union[int, str]]) -> Optional[int]:
+        if num_threads != 'auto':
+            return num_threads
+        local_peas = (getattr(self.runtime_args, 'parallel', None) or 1) * (
+            getattr(self.runtime_args, 'replicas', None) or 1
+        )
+        num_threads = max(1, _cpu_count() // local_peas)
+        self.logger.info(f'Using {num_threads} threads for {local_peas} peas on {_cpu_count()} cores')
+        return num_threads
+
+    def _limit_threads(self):
+        """Apply the thread budget to the calling thread, as the OpenMP setting is per thread"""
+        _set_omp_threads(self.num_threads)
+
+    def _cache_dir(self) -> Optional[str]:
+        root = self.mmap_path or self.workspace
+        if not self.mmap or root is None:
+            return None
+        return os.path.join(root, f'index_{self.runtime_args.pea_id}')
+
+    def _vecs_file_path(self) -> Optional[str]:
+        if self.keep_vectors or self.workspace is None:
+            return None
+        os.makedirs(self.workspace, exist_ok=True)
+        return os.path.join(self.workspace, f'vecs_{self.runtime_args.pea_id}.npy')
+
+    def _release_vectors(self):
+        """Drop the vectors when the index can reconstruct them exactly, in the memory-lean mode"""
+        import faiss
+
+        if self.keep_vectors or not hasattr(self, 'index') or self.normalize:
+            return
+        index = faiss.downcast_index(self._partitions[0])
+        if isinstance(index, faiss.IndexIDMap2) and isinstance(
+            faiss.downcast_index(index.index), faiss.IndexFlat
+        ):
+            self.logger.info('Reconstructing the embeddings from the index')
+            self._vecs = None
+            self._delta_vecs = None
+
+    def _build_from_dump(self, dump_path: str, vecs_path: Optional[str] = None):
+        """Build the index in a single pass over the dump
+
+        The vectors are streamed into a float32 array (memory-mapped at `vecs_path` if given), while
+        at most `max_num_training_points` training points are reservoir-sampled from them. The index
+        is then trained on the sample, or on all the vectors, and the vectors are added in chunks.
+        """
+        self.logger.info('Start building "FaissSearcher" from dump data')
+        ids, vecs = import_vectors(dump_path, str(self.runtime_args.pea_id))
+        self._ids = np.array(list(ids))
+        first = next(vecs, None)
+        if first is None:
+            self.logger.warning('The dump is empty')
+            return False
+        self.num_dim = len(first)
+        self.dtype = first.dtype
+        shape = (len(self._ids), self.num_dim)
+        if vecs_path is None:
+            self._vecs = np.empty(shape, dtype=np.float32)
+        else:
+            self._vecs = np.lib.format.open_memmap(
+                vecs_path, mode='w+', dtype=np.float32, shape=shape
+            )
+
+        def _stored(chunks):
+            start = 0
+            for chunk in chunks:
+                self._vecs[start: start + len(chunk)] = chunk
+                start += len(chunk)
+                yield chunk
+
+        chunks = _stored(_chunked(chain([first], vecs), _BUILD_CHUNK_SIZE))
+        train_data = None
+        if (
+            self._trains_on_dump()
+            and self.max_num_training_points
+            and self.max_num_training_points < len(self._ids)
+        ):
+            train_data = _reservoir_sample(chunks, self.max_num_training_points)
+        else:
+            # without a cap, the index is trained on `self._vecs` rather than on a copy of it
+            for _ in chunks:
+                pass
+        self.index = self._build_index(self._vecs, train_data)
+        return True
+
+    def _trains_on_dump(self) -> bool:
+        return (
+            self.requires_training
+            and not self.train_filepath
+            and not (self.trained_index_path and os.path.exists(self.trained_index_path))
+        )
+
+    def _load_or_build(self, dump_path: str, cache_dir: str):
+        """Memory-map the index built on a previous start, or build it and write it to `cache_dir`
+
+        The manifest ties the written index to the dump and to the parameters it was built with.
+        """
+        import faiss
+
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest_path = os.path.join(cache_dir, _MANIFEST)
+        index_paths = self._index_paths(cache_dir)
+        manifest = {
+            'dump': _dump_fingerprint(dump_path, str(self.runtime_args.pea_id)),
+            'index': self._index_config(),
+        }
+        if _read_manifest(manifest_path) == manifest and all(
+            os.path.exists(path) for path in index_paths
+        ):
+            self.logger.info(f'Memory-mapping the index built in {cache_dir}')
+            self._ids = np.load(os.path.join(cache_dir, _IDS_FILE))
+            self._vecs = np.load(os.path.join(cache_dir, _VECS_FILE), mmap_mode='r')
+            self.num_dim = self._vecs.shape[1]
+            self.dtype = self._vecs.dtype
+            self.index = self._combined(
+                [
+                    self.to_device(faiss.read_index(path, faiss.IO_FLAG_MMAP))
+                    for path in index_paths
+                ]
             )
+            self._mmapped_index_paths = index_paths
+            self._set_search_parameters(self._default_search_parameters())
+            return
+
+        vecs_path = os.path.join(cache_dir, _VECS_FILE)
+        tmp_vecs_path = _tmp_path(vecs_path)
+        if not self._build_from_dump(dump_path, tmp_vecs_path):
+            return
+        self.logger.info(f'Writing the built index to {cache_dir}')
+        for index, path in zip(self._partitions, index_paths):
+            _write_index(index, path, self.on_gpu)
+        _save_npy(os.path.join(cache_dir, _IDS_FILE), self._ids)
+        self._vecs.flush()
+        del self._vecs
+        os.replace(tmp_vecs_path, vecs_path)
+        self._vecs = np.load(vecs_path, mmap_mode='r')
+        _write_manifest(manifest_path, manifest)
+
+    def _index_config(self) -> Dict:
+        config = {
+            'index_key': self.index_key,
+            'metric': self.metric,
+            'normalize': self.normalize,
+            'requires_training': self.requires_training,
+            'max_num_training_points': self.max_num_training_points,
+            'train_filepath': None,
+            'num_partitions': self.num_partitions,
+        }
+        if self.train_filepath and os.path.exists(self.train_filepath):
+            config['train_filepath'] = _file_fingerprint(self.train_filepath)
+        if self.trained_index_path and os.path.exists(self.trained_index_path):
+            config['trained_index'] = _file_fingerprint(self.trained_index_path)
+        return config
+
+    def _index_paths(self, cache_dir: str) -> List[str]:
+        if self.num_partitions == 1:
+            return [os.path.join(cache_dir, _INDEX_FILE)]
+        return [
+            os.path.join(cache_dir, _PARTITION_FILE.format(i))
+            for i in range(self.num_partitions)
+        ]
 
     def device(self):
         """
@@ -124,13 +364,105 @@ class FaissSearcher(Executor):
             else index
         )
 
-    def _build_index(self, vecs: 'np.ndarray'):
+    def _build_index(self, vecs: 'np.ndarray', train_sample: Optional['np.ndarray'] = None):
         """Build an advanced index structure from a numpy array.
 
+        If `trained_index_path` points to a trained index, it is loaded instead of training a new one.
+
         :param vecs: numpy array containing the vectors to index
+        :param train_sample: the training points sampled from `vecs`, if not all of them are used
+        """
+        if self.trained_index_path and os.path.exists(self.trained_index_path):
+            index = self._load_trained_index(self.trained_index_path)
+        else:
+            index = self._new_index(self.num_dim)
+            if self.requires_training:
+                if self.train_filepath:
+                    train_data = self._load_training_data(self.train_filepath)
+                else:
+                    self.logger.info(f'Taking indexed data as training points')
+                    train_data = vecs if train_sample is None else train_sample
+                if train_data is None:
+                    self.logger.warning(
+                        'Loading training data failed. some faiss indexes require previous training.'
+                    )
+                else:
+                    self._train(index, self._prepare_training_data(train_data))
+
+        self.index = self._combined(self._split(self._id_mapped(index)))
+        for start in range(0, len(vecs), _BUILD_CHUNK_SIZE):
+            self._build_partial_index(vecs[start: start + _BUILD_CHUNK_SIZE], start)
+        self._set_search_parameters(self._default_search_parameters())
+        return self.index
+
+    def _split(self, index) -> List:
+        """Copy the trained, empty index into `num_partitions` sub-indexes"""
+        import faiss
+
+        partitions = [index]
+        for _ in range(self.num_partitions - 1):
+            if self.on_gpu:
+                partitions.append(
+                    self.to_device(faiss.clone_index(faiss.index_gpu_to_cpu(index)))
+                )
+            else:
+                partitions.append(faiss.clone_index(index))
+        return partitions
+
+    def _combined(self, partitions: List):
+        """Keep the sub-indexes and return the index holding all of them
+
+        The vector at position `i` is held by the sub-index `i % num_partitions`.
         """
         import faiss
 
+        self._partitions = partitions
+        if len(partitions) == 1:
+            return partitions[0]
+        shards = faiss.IndexShards(partitions[0].d, False, False)
+        shards.metric_type = partitions[0].metric_type
+        for index in partitions:
+            shards.add_shard(index)
+        return shards
+
+    def _search_index(self, vecs: 'np.ndarray', top_k: int):
+        """Search the sub-indexes in the threads of the pool, and merge their top-k"""
+        if len(self._partitions) == 1:
+            return self.index.search(vecs, top_k)
+        results = list(self._pool.map(lambda index: index.search(vecs, top_k), self._partitions))
+        dists = np.concatenate([result[0] for result in results], axis=1)
+        ids = np.concatenate([result[1] for result in results], axis=1)
+        order = np.argsort(
+            -dists if self.metric == 'inner_product' else dists, axis=1, kind='stable'
+        )[:, :top_k]
+        return np.take_along_axis(dists, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def _route(self, positions: 'np.ndarray'):
+        """Yield every sub-index with the selection of the positions it holds"""
+        if len(self._partitions) == 1:
+            yield self._partitions[0], slice(None)
+            return
+        owners = positions % len(self._partitions)
+        for i, index in enumerate(self._partitions):
+            yield index, owners == i
+
+    def _sync(self):
+        if len(self._partitions) > 1:
+            self.index.syncWithSubIndexes()
+
+    def _id_mapped(self, index):
+        """Wrap the index so that vectors can be added and removed by id, unless it supports it natively (IVF)"""
+        import faiss
+
+        try:
+            faiss.extract_index_ivf(index)
+            return index
+        except RuntimeError:
+            return faiss.IndexIDMap2(index)
+
+    def _new_index(self, num_dim: int):
+        import faiss
+
         metric = faiss.METRIC_L2
         if self.metric == 'inner_product':
             self.logger.warning(
@@ -142,50 +474,290 @@ class FaissSearcher(Executor):
                 'Invalid distance metric for Faiss index construction. Defaulting to l2 distance'
             )
 
-        index = self.to_device(
-            index=faiss.index_factory(self.num_dim, self.index_key, metric)
+        return self.to_device(
+            index=faiss.index_factory(num_dim, self.index_key, metric)
         )
 
-        if self.requires_training:
-            if self.train_filepath:
-                train_data = self._load_training_data(self.train_filepath)
-            else:
-                self.logger.info(f'Taking indexed data as training points')
-                train_data = vecs
-            if train_data is None:
-                self.logger.warning(
-                    'Loading training data failed. some faiss indexes require previous training.'
-                )
-            else:
-                if self.max_num_training_points:
-                    self.logger.warning(
-                        f'From train_data with num_points {train_data.shape[0]}, '
-                        f'sample {self.max_num_training_points} points'
-                    )
-                    random_indices = np.random.choice(
-                        train_data.shape[0],
-                        size=min(self.max_num_training_points, train_data.shape[0]),
-                        replace=False,
-                    )
-                    train_data = train_data[random_indices, :]
-                train_data = train_data.astype(np.float32)
-                if self.normalize:
-                    faiss.normalize_L2(train_data)
-                self._train(index, train_data)
+    def _prepare_training_data(self, train_data: 'np.ndarray') -> 'np.ndarray':
+        if self.max_num_training_points and train_data.shape[0] > self.max_num_training_points:
+            self.logger.warning(
+                f'From train_data with num_points {train_data.shape[0]}, '
+                f'sample {self.max_num_training_points} points'
+            )
+            random_indices = np.random.choice(
+                train_data.shape[0],
+                size=min(self.max_num_training_points, train_data.shape[0]),
+                replace=False,
+            )
+            train_data = train_data[random_indices, :]
+        if not self.normalize:
+            # the stored vectors are trained on as they are, without a copy
+            return np.ascontiguousarray(train_data, dtype=np.float32)
+        from faiss import normalize_L2
 
-        self._build_partial_index(vecs, index)
-        index.nprobe = self.nprobe
-        return index
+        train_data = train_data.astype(np.float32)
+        normalize_L2(train_data)
+        return train_data
 
-    def _build_partial_index(self, vecs: 'np.ndarray', index):
+    def _load_trained_index(self, path: str):
+        import faiss
+
+        self.logger.info(f'Loading the trained index from {path}')
+        index = faiss.read_index(path)
+        if index.d != self.num_dim:
+            raise ValueError(
+                f'the trained index has {index.d} dimensions, the indexed vectors have {self.num_dim}'
+            )
+        if not index.is_trained:
+            raise ValueError(f'the index in {path} is not trained')
+        return self.to_device(index)
+
+    @requests(on='/train')
+    def train(self, docs: Optional[DocumentArray], parameters: Optional[Dict] = None, **kwargs):
+        """Train an empty index once and write it to `trained_index_path`, to be shared by all the shards
+
+        The training data are the embeddings of the documents if there are any, or else the `train_filepath`.
+        Shards and replicas started with the same `trained_index_path` then only add their own vectors to it.
+
+        :param docs: the documents whose embeddings are used as training data
+        :param parameters: can override `trained_index_path` and `train_filepath`
+        """
+        self._limit_threads()
+        parameters = parameters or {}
+        path = parameters.get('trained_index_path', self.trained_index_path)
+        if path is None:
+            self.logger.error(f'No "trained_index_path" provided for {self}')
+            return
+        traversal_paths = parameters.get(
+            'traversal_paths', self.default_traversal_paths
+        )
+        embeddings = (
+            [doc.embedding for doc in docs.traverse_flat(traversal_paths) if doc.embedding is not None]
+            if docs
+            else []
+        )
+        if embeddings:
+            train_data = np.stack(embeddings)
+        else:
+            train_filepath = parameters.get('train_filepath', self.train_filepath)
+            if not train_filepath:
+                self.logger.error(f'No documents with embeddings or "train_filepath" provided for {self}')
+                return
+            train_data = self._load_training_data(train_filepath)
+            if train_data is None:
+                self.logger.error(f'Loading training data from {train_filepath} failed')
+                return
+        train_data = self._prepare_training_data(train_data)
+        if not getattr(self, 'num_dim', None):
+            self.num_dim = train_data.shape[1]
+        index = self._new_index(self.num_dim)
+        self._train(index, train_data)
+        _write_index(index, path, self.on_gpu)
+        self.logger.info(f'Wrote the trained index to {path}')
+
+    def _build_partial_index(self, vecs: 'np.ndarray', start: int = 0):
         vecs = vecs.astype(np.float32)
         if self.normalize:
             from faiss import normalize_L2
 
             normalize_L2(vecs)
-        index.add(vecs)
+        # the ids of the vectors in the index are their positions in `_ids`, followed by the appended ones
+        positions = np.arange(start, start + len(vecs), dtype=np.int64)
+        for index, selected in self._route(positions):
+            index.add_with_ids(vecs[selected], positions[selected])
+        self._sync()
+
+    @requests(on='/index')
+    def add(self, docs: Optional[DocumentArray], parameters: Optional[Dict] = None, **kwargs):
+        """Add vectors to the trained index. Documents whose id is already indexed are replaced
+
+        :param docs: the documents to add
+        :param parameters: parameters to the request
+        """
+        self._limit_threads()
+        ids, vecs = self._docs_to_vecs(docs, parameters)
+        if not ids:
+            return
+        with self._lock:
+            if not hasattr(self, 'index') and not self._init_empty_index(vecs.shape[1]):
+                return
+            # checked before the replaced documents are removed
+            self._check_dim(vecs)
+            existing = [_id for _id in ids if _id in self._ext2int]
+            if existing and not self._can_remove('/index', 'replace already indexed documents'):
+                new = [i for i, _id in enumerate(ids) if _id not in self._ext2int]
+                ids, vecs = [ids[i] for i in new], vecs[new]
+                existing = []
+            self._remove(existing)
+            self._append(ids, vecs)
+
+    @requests(on='/update')
+    def update(self, docs: Optional[DocumentArray], parameters: Optional[Dict] = None, **kwargs):
+        """Update the vectors of documents that are already in the index
+
+        :param docs: the documents to update
+        :param parameters: parameters to the request
+        """
+        self._limit_threads()
+        ids, vecs = self._docs_to_vecs(docs, parameters)
+        if not hasattr(self, 'index'):
+            return
+        with self._lock:
+            known = [i for i, _id in enumerate(ids) if _id in self._ext2int]
+            if not known or not self._can_remove('/update', 'update documents'):
+                return
+            ids = [ids[i] for i in known]
+            self._check_dim(vecs)
+            self._remove(ids)
+            self._append(ids, vecs[known])
+
+    @requests(on='/delete')
+    def delete(self, docs: Optional[DocumentArray], parameters: Optional[Dict] = None, **kwargs):
+        """Remove vectors from the index by id
+
+        :param docs: the documents to delete
+        :param parameters: parameters to the request
+        """
+        self._limit_threads()
+        if docs is None or not hasattr(self, 'index'):
+            return
+        traversal_paths = (parameters or {}).get(
+            'traversal_paths', self.default_traversal_paths
+        )
+        with self._lock:
+            ids = [doc.id for doc in docs.traverse_flat(traversal_paths) if doc.id in self._ext2int]
+            if ids and self._can_remove('/delete', 'delete documents'):
+                self._remove(ids)
+
+    def _docs_to_vecs(self, docs: Optional[DocumentArray], parameters: Optional[Dict]):
+        if docs is None:
+            return [], None
+        traversal_paths = (parameters or {}).get(
+            'traversal_paths', self.default_traversal_paths
+        )
+        docs = [doc for doc in docs.traverse_flat(traversal_paths) if doc.embedding is not None]
+        # the last occurrence of an id wins
+        last = {doc.id: i for i, doc in enumerate(docs)}
+        docs = [docs[i] for i in sorted(last.values())]
+        if not docs:
+            return [], None
+        return [doc.id for doc in docs], np.stack([doc.embedding for doc in docs])
+
+    def _init_empty_index(self, num_dim: int) -> bool:
+        """Create the index of an executor started without dump, from `trained_index_path` if needed"""
+        self.num_dim = num_dim
+        if self.trained_index_path and os.path.exists(self.trained_index_path):
+            index = self._load_trained_index(self.trained_index_path)
+        else:
+            index = self._new_index(num_dim)
+            if not index.is_trained:
+                self.logger.error(
+                    f'{self.index_key} requires training, provide a "trained_index_path" or train it with /train'
+                )
+                return False
+        self.index = self._combined(self._split(self._id_mapped(index)))
+        self._set_search_parameters(self._default_search_parameters())
+        self._ids = np.array([], dtype=str)
+        self._vecs = np.empty((0, num_dim), dtype=np.float32)
+        self.dtype = self._vecs.dtype
+        self._ext2int = {}
+        self._release_vectors()
+        return True
+
+    def _ensure_writable(self):
+        """Read the memory-mapped index into memory before its first change, as its mapped lists are read-only"""
+        import faiss
+
+        if self._mmapped_index_paths is None:
+            return
+        self.logger.info('Loading the memory-mapped index into memory to modify it')
+        self.index = self._combined(
+            [self.to_device(faiss.read_index(path)) for path in self._mmapped_index_paths]
+        )
+        self._set_search_parameters(self._default_search_parameters())
+        self._mmapped_index_paths = None
+
+    def _check_dim(self, vecs: 'np.ndarray'):
+        if vecs.shape[1] != self.num_dim:
+            raise ValueError(
+                f'vectors should have {self.num_dim} dimensions, got {vecs.shape[1]}'
+            )
+
+    def _append(self, ids: List[str], vecs: 'np.ndarray'):
+        self._check_dim(vecs)
+        self._ensure_writable()
+        start = len(self._ids) + self._delta_size
+        capacity = 0 if self._delta_vecs is None else len(self._delta_vecs)
+        end = self._delta_size + len(vecs)
+        if end > capacity and self._vecs is not None:
+            capacity = max(end, 2 * capacity, _DELTA_MIN_CAPACITY)
+            grown = np.empty((capacity, self.num_dim), dtype=np.float32)
+            if self._delta_vecs is not None:
+                grown[: self._delta_size] = self._delta_vecs[: self._delta_size]
+            self._delta_vecs = grown
+        if self._vecs is not None:
+            self._delta_vecs[self._delta_size: end] = vecs
+        self._build_partial_index(vecs, start)
+        self._delta_ids.extend(ids)
+        self._delta_size = end
+        for i, _id in enumerate(ids, start=start):
+            self._ext2int[_id] = i
+
+    def _can_remove(self, endpoint: str, action: str) -> bool:
+        """Whether vectors can be removed from the index, logs an error for `endpoint` if they cannot
+
+        Index keys such as HNSW do not implement `remove_ids`, this is probed once on an empty index of the same key.
+        """
+        import faiss
+
+        if self._removable is None:
+            probe = self._id_mapped(self.to_device(faiss.index_factory(self.num_dim, self.index_key)))
+            try:
+                probe.remove_ids(np.array([], dtype=np.int64))
+                self._removable = True
+            except RuntimeError:
+                self._removable = False
+        if not self._removable:
+            self.logger.error(
+                f'{self.index_key} cannot remove vectors, {endpoint} cannot {action}, they are skipped'
+            )
+        return self._removable
+
+    def _remove(self, ids: List[str]):
+        if not ids:
+            return
+        self._ensure_writable()
+        positions = np.array([self._ext2int[_id] for _id in ids], dtype=np.int64)
+        for index, selected in self._route(positions):
+            index.remove_ids(positions[selected])
+        self._sync()
+        for _id in ids:
+            del self._ext2int[_id]
+        self._num_deleted += len(positions)
+
+    def _id_at(self, position: int) -> str:
+        if position < len(self._ids):
+            return self._ids[position]
+        return self._delta_ids[position - len(self._ids)]
+
+    def _vec_at(self, position: int) -> 'np.ndarray':
+        if self._vecs is None:
+            return self._partitions[position % len(self._partitions)].reconstruct(int(position))
+        if position < len(self._ids):
+            return self._vecs[position]
+        return self._delta_vecs[position - len(self._ids)]
 
-        return
+    def _vecs_at(self, positions: 'np.ndarray') -> 'np.ndarray':
+        if self._vecs is None:
+            return np.stack([self._vec_at(position) for position in positions])
+        base_size = len(self._ids)
+        in_base = positions < base_size
+        vecs = np.empty((len(positions), self.num_dim), dtype=np.float32)
+        if in_base.any():
+            vecs[in_base] = self._vecs[positions[in_base]]
+        if not in_base.all():
+            vecs[~in_base] = self._delta_vecs[positions[~in_base] - base_size]
+        return vecs
 
     @requests(on='/search')
     def search(
@@ -196,6 +768,7 @@ class FaissSearcher(Executor):
         :param docs: the DocumentArray containing the documents to search with
         :param parameters: the parameters for the request
         """
+        self._limit_threads()
         if not hasattr(self, 'index'):
             self.logger.warning('Querying against an empty Index')
             return
@@ -207,6 +780,8 @@ class FaissSearcher(Executor):
         traversal_paths = parameters.get(
             'traversal_paths', self.default_traversal_paths
         )
+        return_embeddings = parameters.get('return_embeddings', True)
+        k_factor = int(parameters.get('k_factor', self.k_factor))
 
         query_docs = docs.traverse_flat(traversal_paths)
 
@@ -216,13 +791,35 @@ class FaissSearcher(Executor):
             from faiss import normalize_L2
 
             normalize_L2(vecs)
-        dists, ids = self.index.search(vecs, top_k)
+        overrides = {
+            name: parameters[key]
+            for name, key in (('nprobe', 'nprobe'), ('efSearch', 'ef_search'))
+            if key in parameters
+        }
+        with self._lock:
+            if overrides:
+                # the search parameters are set on the shared index, so they are restored under the lock
+                self._set_search_parameters(overrides)
+                try:
+                    dists, ids = self._search_index(vecs, top_k * k_factor)
+                finally:
+                    self._set_search_parameters(self._default_search_parameters())
+            else:
+                dists, ids = self._search_index(vecs, top_k * k_factor)
+            if k_factor > 1:
+                dists, ids = self._refine(vecs, ids, top_k)
         if self.metric == 'inner_product':
             dists = 1 - dists
         for doc_idx, matches in enumerate(zip(ids, dists)):
             for m_info in zip(*matches):
                 idx, dist = m_info
-                match = Document(id=self._ids[idx], embedding=self._vecs[idx])
+                if idx < 0:
+                    # fewer than top_k vectors were found
+                    continue
+                match = Document(
+                    id=self._id_at(idx),
+                    embedding=self._vec_at(idx) if return_embeddings else None,
+                )
                 if self.is_distance:
                     match.scores[self.metric] = dist
                 else:
@@ -233,6 +830,165 @@ class FaissSearcher(Executor):
 
                 query_docs[doc_idx].matches.append(match)
 
+    def _refine(self, queries: 'np.ndarray', candidates: 'np.ndarray', top_k: int):
+        """Rerank the candidates of every query by their exact distance to the stored vectors
+
+        Returns the distances and positions of the `top_k` best candidates, in the layout of `index.search`.
+        """
+        import faiss
+
+        queries = np.asarray(queries, dtype=np.float32)
+        found = candidates >= 0
+        positions, inverse = np.unique(candidates[found], return_inverse=True)
+        vecs = self._vecs_at(positions).astype(np.float32)
+        if self.normalize:
+            faiss.normalize_L2(vecs)
+        candidate_vecs = np.zeros(candidates.shape + (queries.shape[1],), dtype=np.float32)
+        candidate_vecs[found] = vecs[inverse]
+        if self.metric == 'inner_product':
+            # ranked by decreasing similarity, the same way as the index
+            dists = -np.einsum('qkd,qd->qk', candidate_vecs, queries)
+        else:
+            dists = ((candidate_vecs - queries[:, None, :]) ** 2).sum(axis=-1)
+        dists[~found] = np.finfo(np.float32).max
+        order = np.argsort(dists, axis=1, kind='stable')[:, :top_k]
+        dists = np.take_along_axis(dists, order, axis=1)
+        ids = np.where(
+            np.take_along_axis(found, order, axis=1),
+            np.take_along_axis(candidates, order, axis=1),
+            -1,
+        )
+        if self.metric == 'inner_product':
+            dists = -dists
+        return dists, ids
+
+    def _default_search_parameters(self) -> Dict:
+        search_parameters = {'nprobe': self.nprobe}
+        if self.ef_search is not None:
+            search_parameters['efSearch'] = self.ef_search
+        return search_parameters
+
+    def _set_search_parameters(self, search_parameters: Dict) -> Dict:
+        """Set the search-time parameters that apply to the index type on every sub-index, and return them
+
+        :param search_parameters: values of `nprobe` and `efSearch`
+        """
+        import faiss
+
+        space = faiss.GpuParameterSpace() if self.on_gpu else faiss.ParameterSpace()
+        applied = {}
+        for name, value in search_parameters.items():
+            try:
+                for index in self._partitions:
+                    space.set_index_parameter(index, name, value)
+                applied[name] = value
+            except RuntimeError:
+                # e.g. `nprobe` for a Flat index
+                pass
+        return applied
+
+    @requests(on='/tune')
+    def tune(self, docs: Optional[DocumentArray], parameters: Optional[Dict] = None, **kwargs):
+        """Select the fastest `nprobe` (IVF) or `ef_search` (HNSW) reaching `recall_target`
+
+        The embeddings of the documents are used as held-out queries. Their exact top-k is computed
+        with a flat index over the indexed vectors, then the search parameter is swept and the
+        recall@k and latency of every value are logged and kept in `tuning_curve`.
+
+        :param docs: the documents whose embeddings are used as queries
+        :param parameters: can override `recall_target`, `top_k` and `traversal_paths`
+        """
+        self._limit_threads()
+        import faiss
+
+        if not hasattr(self, 'index'):
+            self.logger.warning('Tuning an empty Index')
+            return
+        parameters = parameters or {}
+        recall_target = parameters.get('recall_target', self.recall_target)
+        top_k = int(parameters.get('top_k', self.default_top_k))
+        traversal_paths = parameters.get(
+            'traversal_paths', self.default_traversal_paths
+        )
+        embeddings = (
+            [doc.embedding for doc in docs.traverse_flat(traversal_paths) if doc.embedding is not None]
+            if docs
+            else []
+        )
+        if not embeddings:
+            self.logger.error('No documents with embeddings to tune with')
+            return
+        queries = np.stack(embeddings).astype(np.float32)
+        if self.normalize:
+            faiss.normalize_L2(queries)
+
+        name, values = self._tuning_grid(top_k)
+        if name is None:
+            self.logger.warning(f'{self.index_key} has no search parameter to tune')
+            return
+
+        exact = faiss.IndexIDMap(
+            faiss.IndexFlatIP(self.num_dim)
+            if self.metric == 'inner_product'
+            else faiss.IndexFlatL2(self.num_dim)
+        )
+        positions = np.fromiter(self._ext2int.values(), dtype=np.int64)
+        positions.sort()
+        for start in range(0, len(positions), _TUNING_CHUNK_SIZE):
+            chunk = positions[start: start + _TUNING_CHUNK_SIZE]
+            vecs = self._vecs_at(chunk)
+            if self.normalize:
+                faiss.normalize_L2(vecs)
+            exact.add_with_ids(vecs, chunk)
+        _, ground_truth = exact.search(queries, top_k)
+
+        self.tuning_curve = []
+        for value in values:
+            self._set_search_parameters({name: value})
+            start = time.perf_counter()
+            _, ids = self._search_index(queries, top_k)
+            latency = (time.perf_counter() - start) / len(queries)
+            recall = np.mean(
+                [
+                    len(np.intersect1d(found, truth)) / len(truth)
+                    for found, truth in zip(ids, ground_truth)
+                ]
+            )
+            self.tuning_curve.append({name: value, 'recall': float(recall), 'latency': latency})
+            self.logger.info(
+                f'{name}={value}: recall@{top_k}={recall:.4f}, {latency * 1e3:.3f}ms per query'
+            )
+
+        reaching = [point for point in self.tuning_curve if point['recall'] >= recall_target]
+        if reaching:
+            best = min(reaching, key=lambda point: point['latency'])
+        else:
+            best = max(self.tuning_curve, key=lambda point: point['recall'])
+            self.logger.warning(
+                f'recall@{top_k} of {recall_target} is not reached, using the highest recall'
+            )
+        if name == 'nprobe':
+            self.nprobe = best[name]
+        else:
+            self.ef_search = best[name]
+        self._set_search_parameters(self._default_search_parameters())
+        self.logger.info(
+            f'Selected {name}={best[name]} with recall@{top_k}={best["recall"]:.4f}'
+        )
+
+    def _tuning_grid(self, top_k: int):
+        """Return the search parameter of the index type and the values to sweep"""
+        import faiss
+
+        try:
+            nlist = faiss.extract_index_ivf(self._partitions[0]).nlist
+            return 'nprobe', _powers_of_two(1, nlist)
+        except RuntimeError:
+            pass
+        if self._set_search_parameters({'efSearch': max(top_k, 16)}):
+            return 'efSearch', _powers_of_two(max(top_k, 16), _MAX_EF_SEARCH)
+        return None, []
+
     def _train(self, index, data: 'np.ndarray', *args, **kwargs) -> None:
         _num_samples, _num_dim = data.shape
         if not self.num_dim:
@@ -249,63 +1005,69 @@ class FaissSearcher(Executor):
 
         index.train(data)
 
-    def _load_training_data(self, train_filepath: str) -> 'np.ndarray':
+    def _load_training_data(self, train_filepath: str) -> Optional['np.ndarray']:
+        """Sample `max_num_training_points` rows of the training file without loading all of it
+
+        `.npy` files are memory-mapped and only the sampled rows are read, gzip files are
+        decompressed chunk by chunk into a reservoir sample.
+        """
         self.logger.info(f'Loading training data from {train_filepath}')
-        result = None
         try:
-            result = self._load_gzip(train_filepath)
+            with open(train_filepath, 'rb') as fp:
+                is_gzip = fp.read(2) == _GZIP_MAGIC
+            if is_gzip:
+                return self._load_gzip(train_filepath)
+            result = np.load(train_filepath, mmap_mode='r')
+            if isinstance(result, np.lib.npyio.NpzFile):
+                self.logger.warning(
+                    '.npz format is not supported. Please save the array in .npy format.'
+                )
+                return None
+            return _sample_rows(result, self.max_num_training_points)
         except Exception as e:
             self.logger.error(
-                'Loading training data from gzip failed, filepath={}, {}'.format(
+                'Loading training data failed, filepath={}, {}'.format(
                     train_filepath, e
                 )
             )
 
-        if result is None:
-            try:
-                result = np.load(train_filepath)
-                if isinstance(result, np.lib.npyio.NpzFile):
-                    self.logger.warning(
-                        '.npz format is not supported. Please save the array in .npy format.'
-                    )
-                    result = None
-            except Exception as e:
-                self.logger.error(
-                    'Loading training data with np.load failed, filepath={}, {}'.format(
-                        train_filepath, e
-                    )
-                )
+    def _load_gzip(self, abspath: str, mode='rb') -> Optional['np.ndarray']:
+        if not self.num_dim:
+            raise ValueError(
+                'the number of dimensions of the gzip training data is unknown before a dump is imported, '
+                'use a .npy file instead'
+            )
+        row_size = self.num_dim * np.dtype(self.dtype).itemsize
 
-        if result is None:
-            try:
-                # Read from binary file:
-                with open(train_filepath, 'rb') as f:
-                    result = f.read()
-            except Exception as e:
-                self.logger.error(
-                    'Loading training data from binary file failed, filepath={}, {}'.format(
-                        train_filepath, e
+        def _chunks():
+            with gzip.open(abspath, mode) as fp:
+                while True:
+                    buffer = fp.read(_BUILD_CHUNK_SIZE * row_size)
+                    if not buffer:
+                        return
+                    yield np.frombuffer(buffer, dtype=self.dtype).reshape(
+                        [-1, self.num_dim]
                     )
-                )
-        return result
 
-    def _load_gzip(self, abspath: str, mode='rb') -> Optional['np.ndarray']:
         try:
             self.logger.info(f'loading index from {abspath}...')
-            with gzip.open(abspath, mode) as fp:
-                return np.frombuffer(fp.read(), dtype=self.dtype).reshape(
-                    [-1, self.num_dim]
-                )
+            if not self.max_num_training_points:
+                return np.concatenate(list(_chunks()))
+            return _reservoir_sample(_chunks(), self.max_num_training_points)
         except EOFError:
             self.logger.error(
                 f'{abspath} is broken/incomplete, perhaps forgot to ".close()" in the last usage?'
             )
 
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+
     @property
     def size(self):
         """Return the nr of elements in the index"""
         if hasattr(self, '_ids'):
-            return len(self._ids)
+            return len(self._ids) + self._delta_size - self._num_deleted
         else:
             return 0
 
@@ -317,8 +1079,120 @@ class FaissSearcher(Executor):
         """
         for doc in docs:
             try:
-                doc.embedding = self._vecs[self._ext2int[doc.id]]
+                doc.embedding = self._vec_at(self._ext2int[doc.id])
             except Exception as e:
                 self.logger.warning(
                     f'Document with id {doc.id} could not be processed. Error: {e}'
                 )
+
+
+def _set_omp_threads(num_threads: Optional[int]):
+    if num_threads:
+        import faiss
+
+        faiss.omp_set_num_threads(num_threads)
+
+
+def _cpu_count() -> int:
+    try:
+        # the cores this process may run on, e.g. within a container's cpuset
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _powers_of_two(low: int, high: int) -> List[int]:
+    values = [low]
+    while values[-1] * 2 < high:
+        values.append(values[-1] * 2)
+    if values[-1] != high:
+        values.append(high)
+    return values
+
+
+def _chunked(rows: Iterable['np.ndarray'], chunk_size: int) -> Iterable['np.ndarray']:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield np.stack(chunk)
+            chunk = []
+    if chunk:
+        yield np.stack(chunk)
+
+
+def _reservoir_sample(chunks: Iterable['np.ndarray'], size: int) -> Optional['np.ndarray']:
+    """Sample `size` rows uniformly from a stream of chunks of rows of unknown length, in a single pass"""
+    sample, seen = None, 0
+    for chunk in chunks:
+        if sample is None:
+            sample = np.empty((size, chunk.shape[1]), dtype=np.float32)
+        filled = max(0, min(size - seen, len(chunk)))
+        sample[seen: seen + filled] = chunk[:filled]
+        # the i-th row of the stream replaces a random row of the sample with probability size / (i + 1)
+        rest = np.arange(seen + filled, seen + len(chunk))
+        slots = (np.random.random(len(rest)) * (rest + 1)).astype(np.int64)
+        replaced = slots < size
+        sample[slots[replaced]] = chunk[rest[replaced] - seen]
+        seen += len(chunk)
+    if sample is None:
+        return None
+    return sample[: min(size, seen)]
+
+
+def _sample_rows(array: 'np.ndarray', size: Optional[int]) -> 'np.ndarray':
+    """Read `size` random rows of a (memory-mapped) array, in the order they are stored"""
+    if size is None or len(array) <= size:
+        return np.asarray(array, dtype=np.float32)
+    # unlike RandomState.choice, the memory of Generator.choice scales with the sample, not the array
+    rows = np.sort(np.random.default_rng().choice(len(array), size, replace=False))
+    return array[rows].astype(np.float32)
+
+
+def _write_index(index, path: str, on_gpu: bool = False):
+    import faiss
+
+    if on_gpu:
+        index = faiss.index_gpu_to_cpu(index)
+    tmp_path = _tmp_path(path)
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _file_fingerprint(path: str) -> List:
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _dump_fingerprint(dump_path: str, pea_id: str) -> Dict:
+    shard_path = os.path.join(dump_path, pea_id)
+    return {
+        name: _file_fingerprint(os.path.join(shard_path, name))
+        for name in ('ids', 'vectors')
+    }
+
+
+def _read_manifest(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _write_manifest(path: str, manifest: Dict):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_path, path)
+
+
+def _tmp_path(path: str) -> str:
+    # unique per process, so that replicas writing to the same directory do not clash
+    root, ext = os.path.splitext(path)
+    return f'{root}.{os.getpid()}.tmp{ext}'
+
+
+def _save_npy(path: str, array: 'np.ndarray'):
+    tmp_path = _tmp_path(path)
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
@@ -0,0 +1,80 @@
+"""QPS and p99 latency of co-located Faiss searchers with and without a thread budget.
+
+Starts `--replicas` processes on the host, as the replicas and shards of a pod would be,
+each searching its own copy of the same index with single-query requests. They are run once
+with the Faiss default (all the cores for every process), and once with the fair share of
+`num_threads: auto` (the cores divided by the number of processes).
+
+Run from the repository root::
+
+    python -m jinahub.indexers.searcher.FaissSearcher.benchmark --replicas 4 --index-key IVF1024,Flat
+"""
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+from . import _cpu_count
+
+
+def _serve(args, num_threads, barrier, results):
+    import faiss
+
+    if num_threads:
+        faiss.omp_set_num_threads(num_threads)
+    rng = np.random.default_rng(0)
+    vecs = rng.random((args.num_docs, args.dim), dtype=np.float32)
+    queries = rng.random((1000, args.dim), dtype=np.float32)
+    index = faiss.index_factory(args.dim, args.index_key)
+    index.train(vecs[: min(len(vecs), 100_000)])
+    index.add(vecs)
+    faiss.ParameterSpace().set_index_parameter(index, 'nprobe', args.nprobe)
+
+    latencies = []
+    barrier.wait()
+    end = time.perf_counter() + args.duration
+    while time.perf_counter() < end:
+        query = queries[len(latencies) % len(queries)][None, :]
+        start = time.perf_counter()
+        index.search(query, args.top_k)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def _run(args, num_threads):
+    barrier = multiprocessing.Barrier(args.replicas)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_serve, args=(args, num_threads, barrier, results))
+        for _ in range(args.replicas)
+    ]
+    for process in processes:
+        process.start()
+    latencies = np.concatenate([results.get() for _ in processes])
+    for process in processes:
+        process.join()
+    return len(latencies) / args.duration, np.percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--num-docs', type=int, default=200_000)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--index-key', default='IVF1024,Flat')
+    parser.add_argument('--nprobe', type=int, default=32)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    fair_share = max(1, _cpu_count() // args.replicas)
+    print(f'{args.replicas} replicas on {_cpu_count()} cores, {args.index_key} N={args.num_docs} dim={args.dim}')
+    for name, num_threads in (('default', None), (f'num_threads={fair_share}', fair_share)):
+        qps, p99 = _run(args, num_threads)
+        print(f'{name:>16}: {qps:8.1f} QPS, p99 {p99 * 1e3:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
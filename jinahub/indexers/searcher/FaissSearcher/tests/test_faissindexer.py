@@ -43,6 +43,23 @@ def metas(tmpdir):
     del os.environ['TEST_WORKSPACE']
 
 
+@pytest.fixture()
+def arange_dump(tmpdir):
+    """Return a function writing vectors to a dump under `tmpdir`, with their positions as ids"""
+
+    def _dump(vectors, shards=1):
+        dump_path = os.path.join(tmpdir, 'dump')
+        export_dump_streaming(
+            dump_path,
+            shards,
+            len(vectors),
+            zip(np.arange(len(vectors)).astype(str), vectors, [b'' for _ in range(len(vectors))]),
+        )
+        return dump_path
+
+    return _dump
+
+
 @pytest.fixture()
 def tmpdir_dump(tmpdir):
     from jina_commons.indexers.dump import export_dump_streaming
@@ -85,7 +102,7 @@ def test_faiss_indexer(metas, tmpdir_dump):
         metas=metas,
         runtime_args={'pea_id': 0},
     )
-    indexer.search(query_docs, parameters={'top_k': 4})
+    indexer.search(query_docs, parameters={'top_k': 4, 'nprobe': 10})
     assert len(query_docs[0].matches) == 4
     for d in query_docs:
         assert (
@@ -114,7 +131,7 @@ def test_faiss_metric(metas, tmpdir_dump, metric, is_distance):
     )
     query = np.array(np.random.random([10, 10]), dtype=np.float32)
     docs = _get_docs_from_vecs(query)
-    indexer.search(docs, parameters={'top_k': 4})
+    indexer.search(docs, parameters={'top_k': 4, 'nprobe': 10})
     assert len(docs[0].matches) == 4
 
     for i in range(len(docs[0].matches) - 1):
@@ -334,3 +351,428 @@ def test_faiss_normalization(metas, distance, tmpdir):
     indexer.search(docs, parameters={'top_k': 2})
     dist = docs.traverse_flat(['m']).get_attributes('scores')
     assert dist[0][distance].value == 1
+
+
+def test_faiss_persisted_index(metas, tmpdir_dump, monkeypatch):
+    train_filepath = os.path.join(os.environ['TEST_WORKSPACE'], 'train.tgz')
+    train_data = np.array(np.random.random([1024, 10]), dtype=np.float32)
+    with gzip.open(train_filepath, 'wb', compresslevel=1) as f:
+        f.write(train_data.tobytes())
+
+    def _search(indexer):
+        docs = _get_docs_from_vecs(query)
+        indexer.search(docs, parameters={'top_k': 4})
+        return docs.traverse_flat(['m']).get_attributes('id')
+
+    kwargs = dict(
+        index_key='IVF10,PQ2',
+        train_filepath=train_filepath,
+        dump_path=tmpdir_dump,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    indexer = FaissSearcher(**kwargs)
+    expected = _search(indexer)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('the index should not be built again')
+
+    with monkeypatch.context() as m:
+        m.setattr(FaissSearcher, '_build_index', _fail)
+        indexer = FaissSearcher(**kwargs)
+        assert indexer.size == len(vec_idx)
+        assert _search(indexer) == expected
+
+        # a different configuration is built again
+        with pytest.raises(AssertionError):
+            FaissSearcher(**dict(kwargs, index_key='IVF10,PQ5'))
+
+
+def test_faiss_shared_trained_index(metas, tmpdir, arange_dump, monkeypatch):
+    num_dim = 10
+    vectors = np.random.random([300, num_dim]).astype(np.float32)
+    dump_path = arange_dump(vectors, shards=2)
+    trained_index_path = os.path.join(tmpdir, 'trained.faiss')
+
+    trainer = FaissSearcher(
+        index_key='IVF10,PQ2',
+        trained_index_path=trained_index_path,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    trainer.train(_get_docs_from_vecs(vectors), parameters={})
+    assert os.path.exists(trained_index_path)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('the shards should not train')
+
+    monkeypatch.setattr(FaissSearcher, '_train', _fail)
+    sizes = 0
+    for pea_id in range(2):
+        indexer = FaissSearcher(
+            index_key='IVF10,PQ2',
+            trained_index_path=trained_index_path,
+            dump_path=dump_path,
+            metas=dict(metas, name=f'faiss_idx_{pea_id}'),
+            runtime_args={'pea_id': pea_id},
+        )
+        sizes += indexer.size
+        docs = _get_docs_from_vecs(vectors[:2])
+        indexer.search(docs, parameters={'top_k': 4})
+        assert len(docs[0].matches) == 4
+    assert sizes == len(vectors)
+
+
+def test_faiss_offline_training(tmpdir, arange_dump, monkeypatch):
+    import faiss
+    from ..train import main
+
+    vectors = np.random.random([300, 8])
+    dump_path = arange_dump(vectors, shards=3)
+    output = os.path.join(tmpdir, 'trained.faiss')
+    monkeypatch.setattr(
+        'sys.argv',
+        ['train', '--dump-path', dump_path, '--index-key', 'IVF4,Flat', '--output', output,
+         '--max-num-training-points', '100'],
+    )
+    main()
+    index = faiss.read_index(output)
+    assert index.is_trained
+    assert index.ntotal == 0
+    assert index.d == 8
+
+
+def test_faiss_tune_nprobe(metas, arange_dump):
+    num_dim = 16
+    vectors = np.random.random([2000, num_dim]).astype(np.float32)
+    dump_path = arange_dump(vectors)
+    indexer = FaissSearcher(
+        index_key='IVF16,Flat',
+        dump_path=dump_path,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    queries = np.random.random([20, num_dim]).astype(np.float32)
+    indexer.tune(_get_docs_from_vecs(queries), parameters={'recall_target': 0.99, 'top_k': 5})
+    assert [point['nprobe'] for point in indexer.tuning_curve] == [1, 2, 4, 8, 16]
+    # probing all the lists is exact
+    assert indexer.tuning_curve[-1]['recall'] == 1
+    assert indexer.nprobe in (point['nprobe'] for point in indexer.tuning_curve if point['recall'] >= 0.99)
+
+    # per-request overrides do not change the tuned value
+    tuned = indexer.nprobe
+    docs = _get_docs_from_vecs(queries)
+    indexer.search(docs, parameters={'top_k': 5, 'nprobe': 16})
+    assert len(docs[0].matches) == 5
+    assert indexer.nprobe == tuned
+
+
+@pytest.mark.parametrize('index_key', ['Flat', 'IVF4,Flat'])
+def test_faiss_index_update_delete(metas, arange_dump, index_key):
+    num_dim = 8
+    vectors = np.random.random([100, num_dim]).astype(np.float32)
+    dump_path = arange_dump(vectors)
+    for _ in range(2):
+        # the second time, the index written by the first one is memory-mapped
+        indexer = FaissSearcher(
+            index_key=index_key,
+            nprobe=4,
+            dump_path=dump_path,
+            metas=metas,
+            runtime_args={'pea_id': 0},
+        )
+
+    def _search_ids(query, top_k=5):
+        docs = _get_docs_from_vecs(query[None, :])
+        indexer.search(docs, parameters={'top_k': top_k})
+        return docs[0].matches.get_attributes('id')
+
+    new_vec = np.full(num_dim, 10, dtype=np.float32)
+    indexer.add(DocumentArray([Document(id='new', embedding=new_vec)]), {})
+    assert indexer.size == 101
+    assert _search_ids(new_vec)[0] == 'new'
+
+    indexer.update(DocumentArray([Document(id='3', embedding=new_vec + 1)]), {})
+    assert indexer.size == 101
+    assert _search_ids(new_vec + 1)[0] == '3'
+    docs = DocumentArray([Document(id='3')])
+    indexer.fill_embedding(docs)
+    np.testing.assert_equal(docs[0].embedding, new_vec + 1)
+
+    # unknown ids are not inserted by an update
+    indexer.update(DocumentArray([Document(id='unknown', embedding=new_vec)]), {})
+    assert indexer.size == 101
+
+    indexer.delete(DocumentArray([Document(id='new'), Document(id='3')]), {})
+    assert indexer.size == 99
+    assert not {'new', '3'} & set(_search_ids(new_vec, top_k=99))
+    # faiss pads the results with -1 when fewer than top_k vectors are left
+    ids = _search_ids(new_vec, top_k=101)
+    assert len(ids) == 99
+    assert not {'new', '3'} & set(ids)
+
+
+def test_faiss_index_update_wrong_dimension(metas, tmpdir_dump):
+    indexer = FaissSearcher(
+        index_key='Flat', dump_path=tmpdir_dump, metas=metas, runtime_args={'pea_id': 0}
+    )
+    _id = indexer._ids[0]
+    for endpoint in (indexer.update, indexer.add):
+        with pytest.raises(ValueError):
+            endpoint(DocumentArray([Document(id=_id, embedding=np.random.random(3))]), {})
+        # the indexed document is left as it was
+        assert indexer.size == len(indexer._ids)
+        assert _id in indexer._ext2int
+
+
+def test_faiss_index_without_remove(metas, tmpdir_dump):
+    indexer = FaissSearcher(
+        index_key='HNSW32', dump_path=tmpdir_dump, metas=metas, runtime_args={'pea_id': 0}
+    )
+    indexer.delete(DocumentArray([Document(id=vec_idx[0])]), {})
+    indexer.update(DocumentArray([Document(id=vec_idx[1], embedding=-vec[1])]), {})
+    indexer.add(
+        DocumentArray(
+            [Document(id=vec_idx[2], embedding=-vec[2]), Document(id='new', embedding=vec[0])]
+        ),
+        {},
+    )
+    assert indexer.size == len(vec_idx) + 1
+    docs = DocumentArray([Document(id=vec_idx[1]), Document(id=vec_idx[2])])
+    indexer.fill_embedding(docs)
+    np.testing.assert_equal(docs[0].embedding, vec[1])
+    np.testing.assert_equal(docs[1].embedding, vec[2])
+
+
+def test_faiss_index_without_dump(metas):
+    indexer = FaissSearcher(index_key='Flat', metas=metas, runtime_args={'pea_id': 0})
+    vectors = np.random.random([10, 4]).astype(np.float32)
+    indexer.add(
+        DocumentArray([Document(id=str(i), embedding=vec) for i, vec in enumerate(vectors)]), {}
+    )
+    assert indexer.size == 10
+    docs = _get_docs_from_vecs(vectors[[7]])
+    indexer.search(docs, parameters={'top_k': 1})
+    assert docs[0].matches[0].id == '7'
+
+
+@pytest.mark.parametrize('metric', ['l2', 'inner_product'])
+def test_faiss_partitions(metas, arange_dump, metric):
+    num_dim = 8
+    vectors = np.random.random([200, num_dim]).astype(np.float32)
+    dump_path = arange_dump(vectors)
+    queries = np.random.random([5, num_dim]).astype(np.float32)
+
+    def _search(indexer):
+        docs = _get_docs_from_vecs(queries)
+        indexer.search(docs, parameters={'top_k': 10})
+        return [doc.matches.get_attributes('id') for doc in docs]
+
+    single = FaissSearcher(
+        index_key='Flat', metric=metric, mmap=False, dump_path=dump_path, metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    for _ in range(2):
+        # the second time, the sub-indexes written by the first one are memory-mapped
+        partitioned = FaissSearcher(
+            index_key='Flat', metric=metric, num_partitions=3, dump_path=dump_path,
+            metas=metas, runtime_args={'pea_id': 0},
+        )
+        assert [index.ntotal for index in partitioned._partitions] == [67, 67, 66]
+        assert _search(partitioned) == _search(single)
+
+    new_vec = queries[0] if metric == 'l2' else queries[0] * 10
+    docs = DocumentArray([Document(id='new', embedding=new_vec)])
+    deleted = DocumentArray([Document(id=_search(single)[1][0])])
+    for indexer in (single, partitioned):
+        indexer.add(docs, {})
+        indexer.delete(deleted, {})
+    assert partitioned.index.ntotal == len(vectors)
+    assert _search(partitioned) == _search(single)
+    assert _search(partitioned)[0][0] == 'new'
+
+
+@pytest.mark.parametrize('metric', ['l2', 'inner_product'])
+def test_faiss_refine(metas, arange_dump, metric):
+    num_dim = 8
+    vectors = np.random.random([1000, num_dim]).astype(np.float32)
+    dump_path = arange_dump(vectors)
+    indexer = FaissSearcher(
+        index_key='PQ2x4',
+        metric=metric,
+        is_distance=True,
+        k_factor=20,
+        dump_path=dump_path,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    queries = np.random.random([10, num_dim]).astype(np.float32)
+    if metric == 'l2':
+        exact = ((vectors[None, :, :] - queries[:, None, :]) ** 2).sum(axis=-1)
+    else:
+        exact = 1 - queries.dot(vectors.T)
+    truth = np.argsort(exact, axis=1)[:, :5]
+
+    def _recall(parameters):
+        docs = _get_docs_from_vecs(queries)
+        indexer.search(docs, parameters={'top_k': 5, **parameters})
+        found = [doc.matches.get_attributes('id') for doc in docs]
+        return docs, np.mean(
+            [len(set(ids) & set(row.astype(str))) / 5 for ids, row in zip(found, truth)]
+        )
+
+    docs, refined = _recall({})
+    _, approximate = _recall({'k_factor': 1})
+    assert refined > approximate
+    assert refined >= 0.9
+    # the scores are the exact distances
+    for query_idx, doc in enumerate(docs):
+        for match in doc.matches:
+            np.testing.assert_allclose(
+                match.scores[metric].value, exact[query_idx, int(match.id)], rtol=1e-4
+            )
+
+
+def test_faiss_num_threads(metas, tmpdir_dump, monkeypatch):
+    import sys
+
+    import faiss
+
+    module = sys.modules[FaissSearcher.__module__]
+    default = faiss.omp_get_max_threads()
+    monkeypatch.setattr(module, '_cpu_count', lambda: 8)
+    indexer = FaissSearcher(
+        index_key='Flat',
+        num_threads='auto',
+        num_partitions=2,
+        dump_path=tmpdir_dump,
+        metas=metas,
+        runtime_args={'pea_id': 0, 'parallel': 2, 'replicas': 2},
+    )
+    try:
+        assert indexer.num_threads == 2
+        docs = _get_docs_from_vecs(query)
+        indexer.search(docs, parameters={'top_k': 4})
+        assert len(docs[0].matches) == 4
+        assert faiss.omp_get_max_threads() == 2
+        # the sub-indexes share the budget of the executor
+        assert indexer._pool.submit(faiss.omp_get_max_threads).result() == 1
+    finally:
+        indexer.close()
+        faiss.omp_set_num_threads(default)
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_faiss_streaming_build(metas, arange_dump, mmap, monkeypatch):
+    num_dim = 8
+    vectors = np.random.random([1000, num_dim])
+    dump_path = arange_dump(vectors)
+    trained_with = []
+    train = FaissSearcher._train
+
+    def _train(self, index, data):
+        trained_with.append(data.shape)
+        train(self, index, data)
+
+    monkeypatch.setattr(FaissSearcher, '_train', _train)
+    indexer = FaissSearcher(
+        index_key='IVF4,Flat',
+        max_num_training_points=300,
+        mmap=mmap,
+        dump_path=dump_path,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    assert trained_with == [(300, num_dim)]
+    assert indexer.index.ntotal == len(vectors)
+    assert indexer._vecs.dtype == np.float32
+    np.testing.assert_allclose(indexer._vecs, vectors, rtol=1e-6)
+
+
+def test_faiss_build_without_training_cap(metas, arange_dump, monkeypatch):
+    num_dim = 8
+    vectors = np.random.random([500, num_dim]).astype(np.float32)
+    dump_path = arange_dump(vectors)
+    trained_with = []
+    train = FaissSearcher._train
+
+    def _train(self, index, data):
+        trained_with.append(data)
+        train(self, index, data)
+
+    monkeypatch.setattr(FaissSearcher, '_train', _train)
+    indexer = FaissSearcher(
+        index_key='IVF4,Flat',
+        mmap=False,
+        dump_path=dump_path,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    # trained on the stored vectors themselves, not on a sampled copy of all of them
+    assert len(trained_with) == 1
+    assert np.shares_memory(trained_with[0], indexer._vecs)
+    assert indexer.index.ntotal == len(vectors)
+
+
+@pytest.mark.parametrize('index_key', ['Flat', 'IVF4,Flat'])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_faiss_without_vectors(metas, arange_dump, index_key, mmap):
+    num_dim = 8
+    vectors = np.random.random([300, num_dim]).astype(np.float32)
+    dump_path = arange_dump(vectors)
+    indexer = FaissSearcher(
+        index_key=index_key,
+        nprobe=4,
+        keep_vectors=False,
+        mmap=mmap,
+        dump_path=dump_path,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    if index_key == 'Flat':
+        assert indexer._vecs is None
+    else:
+        assert isinstance(indexer._vecs, np.memmap)
+
+    docs = _get_docs_from_vecs(vectors[[5]])
+    indexer.search(docs, parameters={'top_k': 1})
+    assert docs[0].matches[0].id == '5'
+    np.testing.assert_equal(docs[0].matches[0].embedding, vectors[5])
+
+    indexer.add(DocumentArray([Document(id='new', embedding=vectors[0] + 1)]), {})
+    docs = DocumentArray([Document(id='new'), Document(id='7')])
+    indexer.fill_embedding(docs)
+    np.testing.assert_equal(docs[0].embedding, vectors[0] + 1)
+    np.testing.assert_equal(docs[1].embedding, vectors[7])
+
+    docs = _get_docs_from_vecs(vectors[[5]])
+    indexer.search(docs, parameters={'top_k': 1, 'return_embeddings': False})
+    assert docs[0].matches[0].embedding is None
+
+
+@pytest.mark.parametrize('file_format', ['npy', 'gzip'])
+def test_faiss_training_data_sample(metas, tmpdir, file_format):
+    train_data = np.random.random([5000, 8]).astype(np.float32)
+    if file_format == 'npy':
+        train_filepath = os.path.join(tmpdir, 'train.npy')
+        np.save(train_filepath, train_data)
+    else:
+        train_filepath = os.path.join(tmpdir, 'train.tgz')
+        with gzip.open(train_filepath, 'wb', compresslevel=1) as f:
+            f.write(train_data.tobytes())
+
+    indexer = FaissSearcher(
+        index_key='IVF4,Flat',
+        train_filepath=train_filepath,
+        max_num_training_points=300,
+        metas=metas,
+        runtime_args={'pea_id': 0},
+    )
+    indexer.num_dim = 8
+    sample = indexer._load_training_data(train_filepath)
+    assert sample.shape == (300, 8)
+    assert sample.dtype == np.float32
+    # every sampled row comes from the file, and none is repeated
+    rows = {row.tobytes() for row in train_data}
+    assert all(row.tobytes() in rows for row in sample)
+    assert len({row.tobytes() for row in sample}) == 300
@@ -0,0 +1,60 @@
+"""Train a Faiss index once for a whole dump, to be shared by all the shards of a FaissSearcher.
+
+The training points are sampled uniformly across all the shards of the dump in a single pass,
+and the trained, empty index is written to `--output`. Start every shard with
+`trained_index_path` pointing to it.
+
+Run from the repository root::
+
+    python -m jinahub.indexers.searcher.FaissSearcher.train --dump-path /tmp/dump \\
+        --index-key IVF1024,PQ64 --output /tmp/trained.faiss
+"""
+
+import argparse
+import os
+from itertools import chain
+
+import faiss
+from jina_commons.indexers.dump import import_vectors
+
+from . import _BUILD_CHUNK_SIZE, _chunked, _reservoir_sample, _write_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dump-path', required=True)
+    parser.add_argument('--index-key', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--metric', choices=['l2', 'inner_product'], default='l2')
+    parser.add_argument('--normalize', action='store_true')
+    parser.add_argument('--max-num-training-points', type=int, default=100_000)
+    args = parser.parse_args()
+
+    shards = sorted(
+        name
+        for name in os.listdir(args.dump_path)
+        if os.path.isdir(os.path.join(args.dump_path, name))
+    )
+    vecs = chain.from_iterable(
+        import_vectors(args.dump_path, shard)[1] for shard in shards
+    )
+    train_data = _reservoir_sample(
+        _chunked(vecs, _BUILD_CHUNK_SIZE), args.max_num_training_points
+    )
+    if train_data is None:
+        raise ValueError(f'no vectors found in {args.dump_path}')
+    if args.normalize:
+        faiss.normalize_L2(train_data)
+
+    metric = (
+        faiss.METRIC_INNER_PRODUCT if args.metric == 'inner_product' else faiss.METRIC_L2
+    )
+    index = faiss.index_factory(train_data.shape[1], args.index_key, metric)
+    print(f'Training {args.index_key} with {len(train_data)} points from {len(shards)} shards')
+    index.train(train_data)
+    _write_index(index, args.output)
+    print(f'Wrote the trained index to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,84 @@
 __copyright__ = "Copyright (c) 2021 Jina AI Limited. All rights reserved."
 __license__ = "Apache-2.0"
 
-from typing import Tuple, Dict, List
+import functools
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Tuple, Dict, List, Optional
 
 import numpy as np
 from jina import Executor, requests, DocumentArray, Document
 
 from jina_commons import get_logger
-from jina_commons.indexers.dump import import_vectors
+from jina_commons.indexers.dump import import_vectors, import_metas
+
+_MANIFEST = 'manifest.json'
+_IDS_FILE = 'ids.npy'
+_VECS_FILE = 'vecs.npy'
+_OPERAND_FILE = 'operand.npy'
+_QUANTIZATION_FILE = 'quantization.npy'
+_PROJECTION_FILE = 'projection.npy'
+_TAGS_FILE = 'tags.npy'
+_PCA_SAMPLE_SIZE = 100000
+_DELTA_MIN_CAPACITY = 1024
+_METRICS = ('cosine', 'euclidean', 'inner_product')
+_PREPARE_CHUNK_SIZE = 65536
 
 
 class NumpySearcher(Executor):
+    """Brute-force vector searcher on top of numpy
+
+    :param dump_path: the path to load ids and vecs
+    :param default_top_k: get tok k vectors
+    :param default_traversal_paths: traverse path on docs, e.g. ['r'], ['c']
+    :param metric: 'cosine', 'euclidean' or 'inner_product'. Cosine is a single product against the
+        pre-normalized index, euclidean is the distance between the normalized vectors, derived from the
+        same product as `sqrt(2 - 2 <q, v>)`, and inner_product is reported as the distance `1 - <q, v>`.
+    :param is_distance: Boolean flag that describes if distance metric need to be reinterpreted as similarities.
+    :param block_size: number of index vectors scanned at once. The distance matrix of a query batch is never
+        larger than `query_batch_size x block_size`, and a running top-k is kept across blocks.
+        If None, the index is scanned as a single block, or one block per worker with `num_workers`; with
+        `quantization`, blocks are capped to 65536 vectors, as each one is cast to float32 while it is scanned.
+    :param query_batch_size: number of queries processed at once. If None, all the queries of a request
+        are processed together.
+    :param mmap: if True, the dump is materialized once into `.npy` files and memory-mapped on later starts,
+        as long as the dump has not changed. If False, the dump is loaded into memory on every start.
+    :param mmap_path: directory where the dump is materialized. Defaults to the workspace. Pointing the
+        replicas of a shard to the same directory lets them share the page cache.
+    :param quantization: None, 'float16' or 'int8'. If set, the index is scanned in this compressed form
+        (int8 uses a per-dimension scale and offset) to select `rescore_factor * top_k` candidates, which
+        are then rescored exactly in float32 against the full vectors.
+    :param rescore_factor: how many candidates per requested result are rescored when `quantization` or
+        `reduce_dim` is set
+    :param num_workers: number of threads scanning index partitions in parallel. The index is split into
+        `num_workers` contiguous partitions (or blocks of `block_size`), each computing its distances and
+        partial top-k in a thread pool before the results are merged. Keep
+        `num_workers x replicas per host` within the number of cores.
+    :param reduce_dim: if set, the index is scanned with vectors reduced to this number of dimensions to
+        select `rescore_factor * top_k` candidates, which are then reranked against the full vectors.
+    :param reduction: 'pca' fits a PCA projection on the index at import time, 'prefix' keeps the first
+        `reduce_dim` dimensions (for Matryoshka-style embeddings). With `mmap`, the projection is stored
+        next to the materialized dump and is not refit on restart.
+    :param compaction_threshold: number of vectors appended through `/index` or `/update`, plus vectors
+        deleted, after which the appended segment and the tombstones are merged into the index by a
+        background compaction. Without deleted vectors, the index (memory-mapped or not) is not rewritten,
+        only the appended vectors are quantized and reduced next to it. These changes live in memory only,
+        the dump is not modified.
+    :param filter_tags: tag keys loaded from the metas of the dump (and taken from the documents sent to
+        `/index` and `/update`), so that searches can be restricted with a `filter` on their values.
+        With `mmap`, the loaded values are stored next to the materialized dump.
+    :param filter_gather_threshold: fraction of the index below which a filtered search gathers the
+        matching vectors and scans only them, instead of scanning the whole index with the others masked
+        out. The cost of a very selective filter then scales with the number of matching vectors.
+    :param cache_size: number of query results kept in an LRU cache, keyed by the query embedding, `top_k`,
+        the metric and the filter. The cache is emptied whenever the index changes. 0 disables it.
+    """
+
     def __init__(
             self,
             dump_path: str = None,
@@ -18,30 +86,335 @@ class NumpySearcher(Executor):
             default_traversal_paths: List[str] = ['r'],
             metric: str = 'cosine',
             is_distance: bool = False,
+            block_size: Optional[int] = None,
+            query_batch_size: Optional[int] = None,
+            mmap: bool = True,
+            mmap_path: Optional[str] = None,
+            quantization: Optional[str] = None,
+            rescore_factor: int = 4,
+            num_workers: int = 1,
+            reduce_dim: Optional[int] = None,
+            reduction: str = 'pca',
+            compaction_threshold: int = 10000,
+            filter_tags: Optional[List[str]] = None,
+            filter_gather_threshold: float = 0.01,
+            cache_size: int = 0,
             **kwargs,
     ):
         super().__init__(**kwargs)
         self.default_traversal_paths = default_traversal_paths
         self.is_distance = is_distance
         self.metric = metric
+        self.block_size = block_size
+        self.query_batch_size = query_batch_size
+        self.mmap = mmap
+        self.mmap_path = mmap_path
+        if quantization not in (None, 'float16', 'int8'):
+            raise ValueError(
+                f'quantization should be None, "float16" or "int8", got {quantization}'
+            )
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self.num_workers = num_workers
+        if reduction not in ('pca', 'prefix'):
+            raise ValueError(f'reduction should be "pca" or "prefix", got {reduction}')
+        self.reduce_dim = reduce_dim
+        self.reduction = reduction
+        self.compaction_threshold = compaction_threshold
+        self.filter_tags = sorted(filter_tags or [])
+        self.filter_gather_threshold = filter_gather_threshold
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._lock = threading.RLock()
+        self._compaction = None
+        self._pool = (
+            ThreadPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+        )
         self.dump_path = dump_path or kwargs.get('runtime_args').get('dump_path')
         self.logger = get_logger(self)
         self.default_top_k = default_top_k
         if self.dump_path is not None:
             self.logger.info(f'Importing data from {self.dump_path}')
-            ids, vecs = import_vectors(self.dump_path, str(self.runtime_args.pea_id))
-            self._ids = np.array(list(ids))
-            self._vecs = np.array(list(vecs))
-            self._ids_to_idx = {}
+            cache_dir = self._cache_dir()
+            if cache_dir is not None:
+                self._load_mmap(cache_dir)
+            else:
+                ids, vecs = import_vectors(self.dump_path, str(self.runtime_args.pea_id))
+                self._ids = np.array(list(ids))
+                self._vecs = np.array(list(vecs))
+                self._tags = dict(zip(self.filter_tags, self._import_tags()))
+                self._prepare_index()
             self.logger.info(f'Imported {len(self._ids)} documents.')
         else:
             self.logger.warning(
                 f'No dump_path provided for {self.__class__.__name__}. Use flow.rolling_update()...'
             )
+            self._ids = np.array([], dtype=str)
+            self._vecs = np.empty((0, 0))
+            self._tags = {key: np.empty(0, dtype=object) for key in self.filter_tags}
+            self._prepare_index()
+        self._reset_delta()
+        self._deleted = np.zeros(len(self._ids), dtype=bool)
+        self._num_deleted = 0
+        self._ids_to_idx = None
+
+    def _cache_dir(self) -> Optional[str]:
+        root = self.mmap_path or self.workspace
+        if not self.mmap or root is None:
+            return None
+        return os.path.join(root, f'dump_{self.runtime_args.pea_id}')
+
+    def _load_mmap(self, cache_dir: str):
+        """Materialize the dump into `.npy` files once and memory-map them on every start"""
+        pea_id = str(self.runtime_args.pea_id)
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest_path = os.path.join(cache_dir, _MANIFEST)
+        manifest = _read_manifest(manifest_path)
+
+        fingerprint = _dump_fingerprint(self.dump_path, pea_id)
+        if manifest.get('dump') != fingerprint:
+            self.logger.info(f'Materializing dump into {cache_dir}')
+            self._materialize_dump(cache_dir)
+            manifest = {'dump': fingerprint}
+            _write_manifest(manifest_path, manifest)
+        else:
+            self.logger.info(f'Memory-mapping materialized dump from {cache_dir}')
+        self._ids = _load_npy(os.path.join(cache_dir, _IDS_FILE))
+        self._vecs = _load_npy(os.path.join(cache_dir, _VECS_FILE))
+
+        tags_path = os.path.join(cache_dir, _TAGS_FILE)
+        if self.filter_tags and manifest.get('tags') != self.filter_tags:
+            _save_npy(tags_path, self._import_tags())
+            manifest['tags'] = self.filter_tags
+            _write_manifest(manifest_path, manifest)
+        self._tags = (
+            dict(zip(self.filter_tags, np.load(tags_path, allow_pickle=True)))
+            if self.filter_tags
+            else {}
+        )
+
+        operand_config = self._operand_config()
+        if manifest.get('operand') != operand_config:
+            self._prepare_index(cache_dir)
+            manifest['operand'] = operand_config
+            _write_manifest(manifest_path, manifest)
+        else:
+            self._load_prepared_index(cache_dir)
+
+    def _materialize_dump(self, cache_dir: str):
+        ids, vecs = import_vectors(self.dump_path, str(self.runtime_args.pea_id))
+        ids = np.array(list(ids))
+        vecs_path = os.path.join(cache_dir, _VECS_FILE)
+        first = next(vecs, None)
+        if first is None:
+            _save_npy(vecs_path, np.empty((0, 0)))
+        else:
+            tmp_path = _tmp_path(vecs_path)
+            out = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=first.dtype, shape=(len(ids), len(first))
+            )
+            out[0] = first
+            for i, vec in enumerate(vecs, start=1):
+                out[i] = vec
+            out.flush()
+            del out
+            os.replace(tmp_path, vecs_path)
+        _save_npy(os.path.join(cache_dir, _IDS_FILE), ids)
+
+    def _import_tags(self) -> 'np.ndarray':
+        """Read the values of `filter_tags` from the metas of the dump, one row per tag key"""
+        tags = np.empty((len(self.filter_tags), len(self._ids)), dtype=object)
+        if not self.filter_tags:
+            return tags
+        _, metas = import_metas(self.dump_path, str(self.runtime_args.pea_id))
+        for i, meta in enumerate(metas):
+            doc_tags = Document(meta).tags
+            for j, key in enumerate(self.filter_tags):
+                tags[j, i] = doc_tags.get(key)
+        return tags
+
+    def _operand_config(self) -> Dict:
+        return {
+            'kind': 'normalized' if self.metric in ('cosine', 'euclidean') else 'raw',
+            'metric': self._scan_metric,
+            'dtype': self.quantization or 'float32',
+            'reduction': self.reduction if self.reduce_dim else None,
+            'reduce_dim': self.reduce_dim,
+        }
+
+    def _prepare_index(self, cache_dir: Optional[str] = None):
+        """Build the transposed float32 operand for the index once.
+
+        Every distance is computed from a single `q @ V.T` product against this
+        operand, which is pre-normalized for cosine and euclidean.
+
+        With `reduce_dim`, the operand holds the reduced vectors, and with
+        `quantization` it is stored in its compressed form.
+
+        :param cache_dir: if given, the prepared index is written to this directory and memory-mapped
+        """
+        self._quantization_params = None
+        self._projection = None
+        if not self._vecs.size:
+            self._index_operand = None
+            return
+        num_docs, dim = self._vecs.shape
+        if self.reduce_dim:
+            if not 0 < self.reduce_dim < dim:
+                raise ValueError(
+                    f'reduce_dim should be between 1 and {dim - 1}, got {self.reduce_dim}'
+                )
+            if self.reduction == 'pca':
+                self._projection = self._fit_projection()
+        shape = (self.reduce_dim or dim, num_docs)
+        dtype = np.dtype(self.quantization or np.float32)
+        if self.quantization == 'int8':
+            self._quantization_params = self._fit_quantization()
+        if cache_dir is None:
+            operand = np.empty(shape, dtype=dtype)
+        else:
+            operand_path = os.path.join(cache_dir, _OPERAND_FILE)
+            tmp_path = _tmp_path(operand_path)
+            operand = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=dtype, shape=shape
+            )
+        for start, chunk in self._vec_chunks():
+            chunk = self._to_operand(chunk)
+            operand[:, start: start + chunk.shape[1]] = self._quantize(chunk)
+        if cache_dir is None:
+            self._index_operand = operand
+            return
+        operand.flush()
+        del operand
+        os.replace(tmp_path, operand_path)
+        if self._quantization_params is not None:
+            _save_npy(os.path.join(cache_dir, _QUANTIZATION_FILE), self._quantization_params)
+        if self._projection is not None:
+            _save_npy(os.path.join(cache_dir, _PROJECTION_FILE), self._projection)
+        self._load_prepared_index(cache_dir)
+
+    def _load_prepared_index(self, cache_dir: str):
+        self._index_operand = None
+        self._quantization_params = None
+        self._projection = None
+        if not self._vecs.size:
+            return
+        self._index_operand = _load_npy(os.path.join(cache_dir, _OPERAND_FILE))
+        if self.quantization == 'int8':
+            self._quantization_params = np.load(os.path.join(cache_dir, _QUANTIZATION_FILE))
+        if self.reduce_dim and self.reduction == 'pca':
+            self._projection = np.load(os.path.join(cache_dir, _PROJECTION_FILE))
+
+    @property
+    def _scan_metric(self) -> str:
+        """Metric used to scan the operand.
+
+        A PCA projection only preserves inner products with the uncentered
+        query, so cosine and euclidean candidates, which are ranked alike on
+        the normalized vectors, are scanned by inner product.
+        """
+        if self.reduce_dim and self.reduction == 'pca' and self.metric in ('cosine', 'euclidean'):
+            return 'inner_product'
+        return self.metric
+
+    def _vec_chunks(self):
+        for start in range(0, len(self._vecs), _PREPARE_CHUNK_SIZE):
+            yield start, self._vecs[start: start + _PREPARE_CHUNK_SIZE].astype(np.float32)
+
+    def _to_space(self, vecs: 'np.ndarray') -> 'np.ndarray':
+        if self.metric in ('cosine', 'euclidean'):
+            return _norm(vecs)
+        return vecs
+
+    def _to_operand(self, vecs: 'np.ndarray') -> 'np.ndarray':
+        vecs = self._to_space(vecs)
+        if self.reduce_dim:
+            vecs = self._reduce(vecs)
+        return vecs.T
+
+    def _fit_projection(self) -> 'np.ndarray':
+        """Fit a PCA projection on a sample of the index, stored as `[mean; components]`"""
+        num_docs = len(self._vecs)
+        sample = np.sort(
+            np.random.choice(num_docs, min(num_docs, _PCA_SAMPLE_SIZE), replace=False)
+        )
+        sample = self._to_space(self._vecs[sample].astype(np.float32)).astype(np.float64)
+        mean = sample.mean(axis=0)
+        _, eigenvectors = np.linalg.eigh(np.cov(sample - mean, rowvar=False))
+        components = eigenvectors[:, ::-1][:, : self.reduce_dim].T
+        return np.vstack([mean, components]).astype(np.float32)
+
+    def _reduce(self, vecs: 'np.ndarray', center: bool = True) -> 'np.ndarray':
+        if self.reduction == 'prefix':
+            vecs = vecs[:, : self.reduce_dim]
+            return _norm(vecs) if self.metric in ('cosine', 'euclidean') else vecs
+        mean, components = self._projection[0], self._projection[1:]
+        if center:
+            vecs = vecs - mean
+        return vecs.dot(components.T)
+
+    def _reduce_queries(self, q_emb: 'np.ndarray') -> 'np.ndarray':
+        if not self.reduce_dim:
+            return q_emb
+        return self._reduce(q_emb, center=self._scan_metric == 'euclidean')
+
+    def _prepare_queries(self, embeddings: 'np.ndarray') -> 'np.ndarray':
+        embeddings = embeddings.astype(np.float32)
+        if self.metric in ('cosine', 'euclidean'):
+            return _norm(embeddings)
+        return embeddings
+
+    def _fit_quantization(self) -> 'np.ndarray':
+        """Compute the per-dimension int8 scale and offset of the operand"""
+        low, high = None, None
+        for _, chunk in self._vec_chunks():
+            chunk = self._to_operand(chunk)
+            chunk_low, chunk_high = chunk.min(axis=1), chunk.max(axis=1)
+            low = chunk_low if low is None else np.minimum(low, chunk_low)
+            high = chunk_high if high is None else np.maximum(high, chunk_high)
+        scale = (high - low) / 255
+        scale[scale == 0] = 1
+        offset = low + 128 * scale
+        return np.stack([scale, offset]).astype(np.float32)
+
+    def _quantize(self, operand: 'np.ndarray') -> 'np.ndarray':
+        if self.quantization == 'int8':
+            scale, offset = self._quantization_params
+            codes = np.rint((operand - offset[:, None]) / scale[:, None])
+            return np.clip(codes, -128, 127).astype(np.int8)
+        return operand
+
+    def _fold_quantization(
+            self, q_emb: 'np.ndarray'
+    ) -> Tuple['np.ndarray', Optional['np.ndarray']]:
+        """Fold the int8 scale and offset into the queries
+
+        `q . (scale * codes + offset)` is computed as `(q * scale) . codes + q . offset`, so that the
+        codes are only cast, never dequantized.
+        """
+        if self.quantization == 'int8':
+            scale, offset = self._quantization_params
+            return q_emb * scale, q_emb.dot(offset)
+        return q_emb, None
 
     @requests(on='/search')
     def search(self, docs: 'DocumentArray', parameters: Dict = None, **kwargs):
-        if not hasattr(self, '_vecs') or not self._vecs.size:
+        """Find the top-k nearest vectors of the documents
+
+        A `filter` in the parameters restricts the search to the vectors of the given
+        `ids`, and/or to the ones whose `tags` have the given values, e.g.
+        `{'filter': {'ids': ['1', '2'], 'tags': {'lang': ['en', 'de']}}}`
+
+        :param docs: the documents to search with
+        :param parameters: parameters to the request
+        """
+        with self._lock:
+            self._search(docs, parameters)
+
+    def _search(self, docs: 'DocumentArray', parameters: Dict):
+        if not self.size:
             self.logger.warning('Searching an empty index')
             return
 
@@ -51,39 +424,573 @@ class NumpySearcher(Executor):
             'traversal_paths', self.default_traversal_paths
         )
 
-        doc_embeddings = docs.traverse_flat(traversal_paths).get_attributes('embedding')
+        query_docs = [
+            doc for doc in docs.traverse_flat(traversal_paths) if doc.embedding is not None
+        ]
 
         if not docs:
             self.logger.info('No documents to search for')
             return
 
-        if not doc_embeddings:
+        if not query_docs:
             self.logger.info('None of the docs have any embeddings')
             return
 
-        doc_embeddings = np.stack(doc_embeddings)
-
-        q_emb = _ext_A(_norm(doc_embeddings))
-        d_emb = _ext_B(_norm(self._vecs))
-        if self.metric == 'cosine':
-            dists = _cosine(q_emb, d_emb)
-        elif self.metric == 'euclidean':
-            dists = _euclidean(q_emb, d_emb)
-        else:
+        if self.metric not in _METRICS:
             self.logger.error(f'Metric {self.metric} not supported.')
-        positions, dist = self._get_sorted_top_k(dists, top_k)
-        for _q, _positions, _dists in zip(docs, positions, dist):
+            return
+
+        q_emb = self._prepare_queries(np.stack([doc.embedding for doc in query_docs]))
+        positions, dist = self._search_cached(q_emb, top_k, parameters.get('filter'))
+        for _q, _positions, _dists in zip(query_docs, positions, dist):
             for position, dist in zip(_positions, _dists):
-                d = Document(id=self._ids[position], embedding=self._vecs[position])
+                if np.isinf(dist):
+                    # deleted vectors, only selected when fewer than top_k are left
+                    continue
+                d = Document(id=self._id_at(position), embedding=self._vec_at(position))
                 if self.is_distance:
                     d.scores[self.metric] = dist
                 else:
-                    if self.metric == 'cosine':
+                    if self.metric in ('cosine', 'inner_product'):
                         d.scores[self.metric] = 1 - dist
                     elif self.metric == 'euclidean':
                         d.scores[self.metric] = 1 / (1 + dist)
                 _q.matches.append(d)
 
+    def _search_cached(
+            self, q_emb: 'np.ndarray', top_k: int, filter: Optional[Dict] = None
+    ) -> Tuple[List['np.ndarray'], List['np.ndarray']]:
+        """Look the queries up in the LRU cache and only search the ones that are missing"""
+        if not self.cache_size:
+            return self._search_top_k(q_emb, top_k, filter)
+        filter_key = json.dumps(filter, sort_keys=True, default=str) if filter else None
+        keys = [
+            (hashlib.sha1(_q_emb.tobytes()).hexdigest(), top_k, self.metric, filter_key)
+            for _q_emb in q_emb
+        ]
+        results = [self._cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        for key, result in zip(keys, results):
+            if result is not None:
+                self._cache.move_to_end(key)
+        if missing:
+            positions, dists = self._search_top_k(q_emb[missing], top_k, filter)
+            for i, _positions, _dists in zip(missing, positions, dists):
+                results[i] = (_positions, _dists)
+                self._cache[keys[i]] = results[i]
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache_hits += len(keys) - len(missing)
+        self._cache_misses += len(missing)
+        self.logger.debug(
+            f'{len(keys) - len(missing)} of {len(keys)} queries found in the cache'
+        )
+        positions, dists = zip(*results)
+        return list(positions), list(dists)
+
+    @property
+    def cache_info(self) -> Dict:
+        """Return the hits, misses and current size of the query result cache"""
+        return {
+            'hits': self._cache_hits,
+            'misses': self._cache_misses,
+            'size': len(self._cache),
+            'max_size': self.cache_size,
+        }
+
+    @requests(on='/cache_info')
+    def report_cache_info(
+            self, docs: Optional['DocumentArray'] = None, parameters: Dict = None, **kwargs
+    ):
+        """Log the statistics of the query result cache, and set them in the `cache_info` tag of the documents
+
+        :param docs: the documents to set the statistics in
+        :param parameters: parameters to the request
+        """
+        with self._lock:
+            info = self.cache_info
+        hit_rate = info['hits'] / max(1, info['hits'] + info['misses'])
+        self.logger.info(
+            f'Query cache: {info["hits"]} hits, {info["misses"]} misses ({hit_rate:.1%} hit rate), '
+            f'{info["size"]} of {info["max_size"]} entries'
+        )
+        for doc in docs or []:
+            doc.tags['cache_info'] = info
+
+    def _search_top_k(
+            self, q_emb: 'np.ndarray', top_k: int, filter: Optional[Dict] = None
+    ) -> Tuple['np.ndarray', 'np.ndarray']:
+        excluded = self._deleted if self._num_deleted else None
+        gathered = None
+        if filter:
+            allowed = self._filter_mask(filter)
+            excluded = ~allowed
+            num_allowed = int(allowed.sum())
+            if num_allowed <= self.filter_gather_threshold * len(allowed):
+                gathered = np.flatnonzero(allowed)
+        batch_size = self.query_batch_size or len(q_emb)
+        results = []
+        for start in range(0, len(q_emb), batch_size):
+            batch = q_emb[start: start + batch_size]
+            if gathered is not None:
+                results.append(self._search_positions(batch, gathered, top_k))
+                continue
+            positions, dists = None, None
+            if self._index_operand is not None and len(self._ids) + self._tail_size:
+                if self.quantization or self.reduce_dim:
+                    positions, _ = self._scan(
+                        self._reduce_queries(batch), self.rescore_factor * top_k, excluded
+                    )
+                    positions, dists = self._rescore(batch, positions, top_k, excluded)
+                else:
+                    positions, dists = self._scan(batch, top_k, excluded)
+            if self._delta_size > self._tail_size:
+                delta_positions, delta_dists = self._scan_delta(batch, top_k, excluded)
+                if positions is None:
+                    positions, dists = delta_positions, delta_dists
+                else:
+                    positions, dists = self._merge_top_k(
+                        positions, dists, delta_positions, delta_dists, top_k
+                    )
+            results.append((positions, dists))
+        positions, dists = zip(*results)
+        return np.concatenate(positions), np.concatenate(dists)
+
+    def _filter_mask(self, filter: Dict) -> 'np.ndarray':
+        """Turn a filter into a boolean mask over the positions of the index and of the appended segment"""
+        allowed = ~self._deleted[: len(self._ids) + self._delta_size]
+        if 'ids' in filter:
+            positions = [self._position_of(_id) for _id in filter['ids']]
+            in_ids = np.zeros_like(allowed)
+            in_ids[[position for position in positions if position is not None]] = True
+            allowed &= in_ids
+        for key, values in filter.get('tags', {}).items():
+            if key not in self._tags:
+                self.logger.warning(
+                    f'Tag {key} is not in filter_tags {self.filter_tags}, no vector matches it'
+                )
+                allowed[:] = False
+                continue
+            column = np.concatenate(
+                [self._tags[key], _object_array(self._delta_tags[key])]
+            )
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            in_values = np.zeros_like(allowed)
+            for value in values:
+                in_values |= column == value
+            allowed &= in_values
+        return allowed
+
+    def _search_positions(
+            self, q_emb: 'np.ndarray', positions: 'np.ndarray', top_k: int
+    ) -> Tuple['np.ndarray', 'np.ndarray']:
+        """Scan only the gathered full vectors at the given positions, in chunks"""
+        result_positions = np.empty((len(q_emb), 0), dtype=int)
+        result_dists = np.empty((len(q_emb), 0), dtype=np.float32)
+        chunk_size = self.block_size or _PREPARE_CHUNK_SIZE
+        for start in range(0, len(positions), chunk_size):
+            chunk = positions[start: start + chunk_size]
+            vecs = self._to_space(self._vecs_at(chunk))
+            idx, dists = self._get_sorted_top_k(
+                self._distances(q_emb, vecs.T), top_k
+            )
+            result_positions, result_dists = self._merge_top_k(
+                result_positions, result_dists, chunk[idx], dists, top_k
+            )
+        return result_positions, result_dists
+
+    def _scan(
+            self, q_emb: 'np.ndarray', top_k: int, excluded: Optional['np.ndarray'] = None
+    ) -> Tuple['np.ndarray', 'np.ndarray']:
+        """Scan the index, and the compacted tail of the appended segment, block by block, keeping a
+        running top-k per query.
+
+        With `num_workers > 1` the blocks are scanned in the thread pool.
+        """
+        segments = [(0, self._index_operand)]
+        if self._tail_size:
+            segments.append((len(self._ids), self._tail_operand[: self._tail_size].T))
+        num_docs = sum(operand.shape[1] for _, operand in segments)
+        block_size = self.block_size or -(-num_docs // self.num_workers)
+        if self.quantization and not self.block_size:
+            # every block is cast to float32 while it is scanned
+            block_size = min(block_size, _PREPARE_CHUNK_SIZE)
+        q_emb, q_offset = self._fold_quantization(q_emb)
+        scan_block = functools.partial(
+            self._scan_block, q_emb, top_k=top_k, q_offset=q_offset, excluded=excluded
+        )
+        blocks = [
+            (operand[:, start: start + block_size], offset + start)
+            for offset, operand in segments
+            for start in range(0, operand.shape[1], block_size)
+        ]
+        results = (
+            self._pool.map(lambda block: scan_block(*block), blocks)
+            if self._pool is not None
+            else (scan_block(*block) for block in blocks)
+        )
+        positions, dists = None, None
+        for block_positions, block_dists in results:
+            if positions is None:
+                positions, dists = block_positions, block_dists
+            else:
+                positions, dists = self._merge_top_k(
+                    positions, dists, block_positions, block_dists, top_k
+                )
+        return positions, dists
+
+    def _scan_block(
+            self,
+            q_emb: 'np.ndarray',
+            block: 'np.ndarray',
+            start: int,
+            top_k: int,
+            q_offset: Optional['np.ndarray'] = None,
+            excluded: Optional['np.ndarray'] = None,
+    ) -> Tuple['np.ndarray', 'np.ndarray']:
+        block = block.astype(np.float32, copy=False)
+        dots = q_emb.dot(block)
+        if q_offset is not None:
+            dots += q_offset[:, None]
+        block_dists = _dot_distances(dots, self._scan_metric)
+        if excluded is not None:
+            block_excluded = excluded[start: start + block_dists.shape[1]]
+            if block_excluded.any():
+                block_dists[:, block_excluded] = np.inf
+        block_positions, block_dists = self._get_sorted_top_k(block_dists, top_k)
+        return block_positions + start, block_dists
+
+    def _scan_delta(
+            self, q_emb: 'np.ndarray', top_k: int, excluded: Optional['np.ndarray'] = None
+    ) -> Tuple['np.ndarray', 'np.ndarray']:
+        """Scan the appended vectors that are not compacted yet, which are few and kept in full precision"""
+        dists = self._distances(
+            q_emb,
+            self._delta_operand[self._tail_size: self._delta_size].T,
+        )
+        start = len(self._ids) + self._tail_size
+        if excluded is not None:
+            delta_excluded = excluded[start: len(self._ids) + self._delta_size]
+            if delta_excluded.any():
+                dists[:, delta_excluded] = np.inf
+        positions, dists = self._get_sorted_top_k(dists, top_k)
+        return positions + start, dists
+
+    def _rescore(
+            self,
+            q_emb: 'np.ndarray',
+            candidates: 'np.ndarray',
+            top_k: int,
+            excluded: Optional['np.ndarray'] = None,
+    ) -> Tuple['np.ndarray', 'np.ndarray']:
+        """Compute exact float32 distances for the candidates of every query and keep the top-k"""
+        dists = []
+        for _q_emb, _candidates in zip(q_emb, candidates):
+            vecs = self._vecs_at(_candidates)
+            dists.append(
+                self._distances(_q_emb[None, :], self._to_space(vecs).T)[0]
+            )
+        dists = np.stack(dists)
+        if excluded is not None:
+            dists[excluded[candidates]] = np.inf
+        idx, dists = self._get_sorted_top_k(dists, top_k)
+        return np.take_along_axis(candidates, idx, axis=1), dists
+
+    def _distances(
+            self,
+            q_emb: 'np.ndarray',
+            d_emb: 'np.ndarray',
+            metric: Optional[str] = None,
+    ) -> 'np.ndarray':
+        metric = metric or self.metric
+        if metric == 'cosine':
+            return _cosine(q_emb, d_emb)
+        if metric == 'inner_product':
+            return _inner_product(q_emb, d_emb)
+        return _euclidean(q_emb, d_emb)
+
+    @classmethod
+    def _merge_top_k(
+            cls,
+            positions_a: 'np.ndarray',
+            dists_a: 'np.ndarray',
+            positions_b: 'np.ndarray',
+            dists_b: 'np.ndarray',
+            top_k: int,
+    ) -> Tuple['np.ndarray', 'np.ndarray']:
+        positions = np.concatenate([positions_a, positions_b], axis=1)
+        dists = np.concatenate([dists_a, dists_b], axis=1)
+        idx, dists = cls._get_sorted_top_k(dists, top_k)
+        return np.take_along_axis(positions, idx, axis=1), dists
+
+    @requests(on='/index')
+    def index(self, docs: 'DocumentArray', parameters: Dict = None, **kwargs):
+        """Append vectors to the index. Documents whose id is already indexed are replaced
+
+        :param docs: the documents to add
+        :param parameters: parameters to the request
+        """
+        ids, vecs, tags = self._docs_to_vecs(docs, parameters)
+        if not ids:
+            return
+        with self._lock:
+            # checked before the replaced documents are deleted
+            self._check_dim(vecs)
+            self._delete_ids(ids)
+            self._append(ids, vecs, tags)
+        self._maybe_compact()
+
+    @requests(on='/update')
+    def update(self, docs: 'DocumentArray', parameters: Dict = None, **kwargs):
+        """Update the vectors of documents that are already in the index
+
+        :param docs: the documents to update
+        :param parameters: parameters to the request
+        """
+        ids, vecs, tags = self._docs_to_vecs(docs, parameters)
+        with self._lock:
+            known = [i for i, _id in enumerate(ids) if self._position_of(_id) is not None]
+            if not known:
+                return
+            ids = [ids[i] for i in known]
+            self._check_dim(vecs)
+            self._delete_ids(ids)
+            self._append(ids, vecs[known], [tags[i] for i in known])
+        self._maybe_compact()
+
+    @requests(on='/delete')
+    def delete(self, docs: 'DocumentArray', parameters: Dict = None, **kwargs):
+        """Delete vectors from the index by id. They are masked out until the next compaction
+
+        :param docs: the documents to delete
+        :param parameters: parameters to the request
+        """
+        traversal_paths = (parameters or {}).get(
+            'traversal_paths', self.default_traversal_paths
+        )
+        if docs is None:
+            return
+        with self._lock:
+            self._delete_ids([doc.id for doc in docs.traverse_flat(traversal_paths)])
+        self._maybe_compact()
+
+    @property
+    def size(self):
+        """Return the nr of vectors in the index"""
+        return len(self._ids) + self._delta_size - self._num_deleted
+
+    def _docs_to_vecs(
+            self, docs: Optional['DocumentArray'], parameters: Optional[Dict]
+    ) -> Tuple[List[str], 'np.ndarray', List[Dict]]:
+        traversal_paths = (parameters or {}).get(
+            'traversal_paths', self.default_traversal_paths
+        )
+        if docs is None:
+            return [], np.empty((0, 0)), []
+        docs = [doc for doc in docs.traverse_flat(traversal_paths) if doc.embedding is not None]
+        if not docs:
+            return [], np.empty((0, 0)), []
+        # the last occurrence of an id wins
+        last = {doc.id: i for i, doc in enumerate(docs)}
+        docs = [docs[i] for i in sorted(last.values())]
+        tags = [{key: doc.tags.get(key) for key in self.filter_tags} for doc in docs]
+        return [doc.id for doc in docs], np.stack([doc.embedding for doc in docs]), tags
+
+    def _id_at(self, position: int) -> str:
+        base_size = len(self._ids)
+        if position < base_size:
+            return self._ids[position]
+        return self._delta_ids[position - base_size]
+
+    def _vec_at(self, position: int) -> 'np.ndarray':
+        base_size = len(self._ids)
+        if position < base_size:
+            return self._vecs[position]
+        return self._delta_vecs[position - base_size]
+
+    def _vecs_at(self, positions: 'np.ndarray') -> 'np.ndarray':
+        base_size = len(self._ids)
+        in_base = positions < base_size
+        dim = self._vecs.shape[1] if self._vecs.size else self._delta_vecs.shape[1]
+        vecs = np.empty((len(positions), dim), dtype=np.float32)
+        if in_base.any():
+            vecs[in_base] = self._vecs[positions[in_base]]
+        if not in_base.all():
+            vecs[~in_base] = self._delta_vecs[positions[~in_base] - base_size]
+        return vecs
+
+    def _position_of(self, doc_id: str) -> Optional[int]:
+        if self._ids_to_idx is None:
+            all_ids = chain(self._ids, self._delta_ids[: self._delta_size])
+            self._ids_to_idx = {
+                _id: position
+                for position, _id in enumerate(all_ids)
+                if not self._deleted[position]
+            }
+        return self._ids_to_idx.get(doc_id)
+
+    def _delete_ids(self, ids: List[str]):
+        self._cache.clear()
+        for _id in ids:
+            position = self._position_of(_id)
+            if position is not None:
+                self._deleted[position] = True
+                self._num_deleted += 1
+                del self._ids_to_idx[_id]
+
+    def _reset_delta(self):
+        self._delta_ids = []
+        self._delta_vecs = None
+        self._delta_operand = None
+        self._delta_tags = {key: [] for key in self.filter_tags}
+        self._delta_size = 0
+        self._tail_operand = None
+        self._tail_size = 0
+
+    def _check_dim(self, vecs: 'np.ndarray'):
+        if self._vecs.ndim == 2 and self._vecs.shape[1]:
+            dim = self._vecs.shape[1]
+        elif self._delta_vecs is not None:
+            dim = self._delta_vecs.shape[1]
+        else:
+            return
+        if vecs.shape[1] != dim:
+            raise ValueError(f'vectors should have {dim} dimensions, got {vecs.shape[1]}')
+
+    def _append(self, ids: List[str], vecs: 'np.ndarray', tags: List[Dict]):
+        """Append vectors to the growable segment, kept in full precision until compaction"""
+        self._check_dim(vecs)
+        self._cache.clear()
+        vecs = vecs.astype(np.float32)
+        start, end = self._delta_size, self._delta_size + len(vecs)
+        capacity = 0 if self._delta_vecs is None else len(self._delta_vecs)
+        if end > capacity:
+            capacity = max(end, 2 * capacity, _DELTA_MIN_CAPACITY)
+            self._delta_vecs = _grow(self._delta_vecs, capacity, vecs.shape[1])
+            self._delta_operand = _grow(self._delta_operand, capacity, vecs.shape[1])
+            self._deleted = _grow(self._deleted, len(self._ids) + capacity)
+        operand = self._to_space(vecs)
+        self._delta_vecs[start:end] = vecs
+        self._delta_operand[start:end] = operand
+        self._delta_ids.extend(ids)
+        for key, values in self._delta_tags.items():
+            values.extend(doc_tags.get(key) for doc_tags in tags)
+        self._delta_size = end
+        if self._ids_to_idx is not None:
+            base_size = len(self._ids)
+            for i, _id in enumerate(ids, start=base_size + start):
+                self._ids_to_idx[_id] = i
+
+    def _maybe_compact(self):
+        if self._delta_size - self._tail_size + self._num_deleted < self.compaction_threshold:
+            return
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        self._compaction = threading.Thread(target=self._compact, daemon=True)
+        self._compaction.start()
+
+    def _compact(self):
+        """Merge the appended segment into the index and drop the deleted vectors.
+
+        Without deleted vectors, the index is left as it is (memory-mapped or not), and only the
+        vectors appended since the last compaction are brought into its scanned form, in the tail.
+        Otherwise the new index is built outside of the lock from a snapshot. Vectors
+        appended or deleted meanwhile are carried over when it is swapped in.
+        """
+        with self._lock:
+            if self._index_operand is not None and not self._num_deleted:
+                tail_size, delta_size = self._tail_size, self._delta_size
+                new_vecs = self._delta_vecs[tail_size:delta_size] if delta_size else None
+                compact_tail = True
+            else:
+                compact_tail = False
+        if compact_tail:
+            if delta_size > tail_size:
+                self._compact_tail(new_vecs, tail_size, delta_size)
+            return
+        with self._lock:
+            base_size, delta_size = len(self._ids), self._delta_size
+            deleted = self._deleted[: base_size + delta_size].copy()
+            delta_ids = np.array(self._delta_ids[:delta_size], dtype=str)
+            delta_vecs = self._delta_vecs[:delta_size] if delta_size else None
+            delta_tags = {
+                key: _object_array(values[:delta_size])
+                for key, values in self._delta_tags.items()
+            }
+        keep_base = np.flatnonzero(~deleted[:base_size])
+        keep_delta = np.flatnonzero(~deleted[base_size:])
+        self.logger.info(
+            f'Compacting {len(keep_base)} indexed and {len(keep_delta)} appended vectors'
+        )
+        ids, vecs = self._ids[keep_base], self._vecs[keep_base]
+        tags = {
+            key: np.concatenate([self._tags[key][keep_base], delta_tags[key][keep_delta]])
+            for key in self.filter_tags
+        }
+        operand = None
+        if delta_size:
+            new_vecs = delta_vecs[keep_delta]
+            ids = np.concatenate([ids, delta_ids[keep_delta]])
+            vecs = np.concatenate([vecs, new_vecs]) if base_size else new_vecs
+            if self._index_operand is not None:
+                new_operand = self._to_operand(new_vecs)
+                operand = np.concatenate(
+                    [self._index_operand[:, keep_base], self._quantize(new_operand)], axis=1
+                )
+        elif self._index_operand is not None:
+            operand = self._index_operand[:, keep_base]
+
+        with self._lock:
+            kept = np.concatenate([keep_base, base_size + keep_delta])
+            total = len(self._ids) + self._delta_size
+            new_deleted = self._deleted[kept]
+            pending_deleted = self._deleted[base_size + delta_size: total]
+            pending_ids = self._delta_ids[delta_size: self._delta_size]
+            pending_vecs = (
+                self._delta_vecs[delta_size: self._delta_size] if pending_ids else None
+            )
+            pending_tags = [
+                {key: values[i] for key, values in self._delta_tags.items()}
+                for i in range(delta_size, self._delta_size)
+            ]
+            self._ids, self._vecs, self._tags = ids, vecs, tags
+            if operand is not None:
+                self._index_operand = operand
+            else:
+                # the index was empty, so the operand and its parameters are fitted now
+                self._prepare_index()
+            self._reset_delta()
+            self._deleted = new_deleted
+            if pending_ids:
+                self._append(pending_ids, pending_vecs, pending_tags)
+                self._deleted[len(self._ids): len(self._ids) + len(pending_ids)] = pending_deleted
+            self._num_deleted = int(self._deleted.sum())
+            self._ids_to_idx = None
+            self._cache.clear()
+
+    def _compact_tail(self, new_vecs: 'np.ndarray', tail_size: int, delta_size: int):
+        """Append the scanned form of the appended vectors `tail_size:delta_size` to the tail"""
+        self.logger.info(f'Compacting {len(new_vecs)} appended vectors')
+        operand = self._quantize(self._to_operand(new_vecs)).T
+        with self._lock:
+            capacity = 0 if self._tail_operand is None else len(self._tail_operand)
+            if delta_size > capacity:
+                capacity = max(delta_size, 2 * capacity, _DELTA_MIN_CAPACITY)
+                self._tail_operand = _grow(
+                    self._tail_operand, capacity, operand.shape[1], dtype=operand.dtype
+                )
+            self._tail_operand[tail_size:delta_size] = operand
+            self._tail_size = delta_size
+            self._cache.clear()
+
+    def close(self) -> None:
+        """
+        Shut down the thread pool scanning the index
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+
     @staticmethod
     def _get_sorted_top_k(
             dist: 'np.array', top_k: int
@@ -101,35 +1008,89 @@ class NumpySearcher(Executor):
         return idx, dist
 
 
-def _get_ones(x, y):
-    return np.ones((x, y))
+def _dump_fingerprint(dump_path: str, pea_id: str) -> Dict:
+    shard_path = os.path.abspath(os.path.join(dump_path, pea_id))
+    fingerprint = {'path': shard_path}
+    for name in ('ids', 'vectors', 'metas'):
+        if not os.path.exists(os.path.join(shard_path, name)):
+            continue
+        stat = os.stat(os.path.join(shard_path, name))
+        fingerprint[name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def _read_manifest(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _write_manifest(path: str, manifest: Dict):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_path, path)
+
+
+def _tmp_path(path: str) -> str:
+    # unique per process, so that replicas materializing the same dump do not clash
+    root, ext = os.path.splitext(path)
+    return f'{root}.{os.getpid()}.tmp{ext}'
 
 
-def _ext_A(A):
-    nA, dim = A.shape
-    A_ext = _get_ones(nA, dim * 3)
-    A_ext[:, dim: 2 * dim] = A
-    A_ext[:, 2 * dim:] = A ** 2
-    return A_ext
+def _save_npy(path: str, array: 'np.ndarray'):
+    tmp_path = _tmp_path(path)
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
 
 
-def _ext_B(B):
-    nB, dim = B.shape
-    B_ext = _get_ones(dim * 3, nB)
-    B_ext[:dim] = (B ** 2).T
-    B_ext[dim: 2 * dim] = -2.0 * B.T
-    del B
-    return B_ext
+def _load_npy(path: str) -> 'np.ndarray':
+    array = np.load(path, mmap_mode='r')
+    if not array.size:
+        return np.load(path)
+    return array
 
 
-def _euclidean(A_ext, B_ext):
-    sqdist = A_ext.dot(B_ext).clip(min=0)
-    return np.sqrt(sqdist)
+def _grow(
+        array: Optional['np.ndarray'], capacity: int, *dims: int, dtype=np.float32
+) -> 'np.ndarray':
+    if array is None:
+        return np.zeros((capacity, *dims), dtype=dtype)
+    grown = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def _object_array(values: List) -> 'np.ndarray':
+    # assigned elementwise, so that sequence values are not turned into extra dimensions
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
 
 
 def _norm(A):
     return A / np.linalg.norm(A, ord=2, axis=1, keepdims=True)
 
 
-def _cosine(A_norm_ext, B_norm_ext):
-    return A_norm_ext.dot(B_norm_ext).clip(min=0) / 2
+def _cosine(A_norm, B_norm_T):
+    return (1 - A_norm.dot(B_norm_T)).clip(min=0)
+
+
+def _inner_product(A, B_T):
+    return 1 - A.dot(B_T)
+
+
+def _euclidean(A_norm, B_norm_T):
+    return _dot_distances(A_norm.dot(B_norm_T), 'euclidean')
+
+
+def _dot_distances(dots, metric):
+    """The distances of `metric` from the inner products of the (normalized for cosine and euclidean) vectors"""
+    if metric == 'cosine':
+        return (1 - dots).clip(min=0)
+    if metric == 'inner_product':
+        return 1 - dots
+    # ||a - b||^2 = 2 - 2 <a, b> for normalized vectors
+    return np.sqrt((2 - 2 * dots).clip(min=0))
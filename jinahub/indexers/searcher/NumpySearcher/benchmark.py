@@ -0,0 +1,75 @@
+"""Per-query latency of the NumpySearcher distance computation.
+
+Compares normalizing and extending the whole index into a `(3 * dim, N)`
+operand on every query (the original behaviour) against a single product
+with the operand prepared once at load time.
+
+Run from the repository root::
+
+    python -m jinahub.indexers.searcher.NumpySearcher.benchmark --num-docs 1000000 --dim 768
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from . import _cosine, _norm
+
+
+def _ext_A(A):
+    nA, dim = A.shape
+    A_ext = np.ones((nA, dim * 3))
+    A_ext[:, dim: 2 * dim] = A
+    A_ext[:, 2 * dim:] = A ** 2
+    return A_ext
+
+
+def _ext_B(B):
+    nB, dim = B.shape
+    B_ext = np.ones((dim * 3, nB))
+    B_ext[:dim] = (B ** 2).T
+    B_ext[dim: 2 * dim] = -2.0 * B.T
+    return B_ext
+
+
+def _time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return np.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-docs', type=int, default=1_000_000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--num-queries', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vecs = rng.random((args.num_docs, args.dim), dtype=np.float32)
+    queries = rng.random((args.num_queries, args.dim), dtype=np.float32)
+
+    def per_query():
+        q_emb = _ext_A(_norm(queries.astype(np.float64)))
+        q_emb.dot(_ext_B(_norm(vecs.astype(np.float64)))).clip(min=0) / 2
+
+    start = time.perf_counter()
+    operand = _norm(vecs).T
+    prepare = time.perf_counter() - start
+
+    def prepared():
+        _cosine(_norm(queries), operand)
+
+    print(f'N={args.num_docs} dim={args.dim} queries={args.num_queries}')
+    print(f'one-off preparation at load: {prepare:.3f}s')
+    print(f'before (operand built per query): {_time(per_query, args.repeat):.3f}s')
+    print(f'after (prepared operand):        {_time(prepared, args.repeat):.3f}s')
+
+
+if __name__ == '__main__':
+    main()
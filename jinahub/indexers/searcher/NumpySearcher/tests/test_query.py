@@ -1,8 +1,10 @@
 import os
+import shutil
 
 import numpy as np
 import pytest
 from jina import Document, DocumentArray
+from jina_commons.indexers.dump import export_dump_streaming
 
 from .. import NumpySearcher
 
@@ -29,8 +31,8 @@ def test_query_vector(tmpdir):
 
 
 @pytest.mark.parametrize(['metric', 'is_distance'],
-                         [('cosine', True), ('euclidean', True),
-                          ('cosine', False), ('euclidean', False)])
+                         [('cosine', True), ('euclidean', True), ('inner_product', True),
+                          ('cosine', False), ('euclidean', False), ('inner_product', False)])
 def test_metric(tmpdir, metric, is_distance):
     runtime = {
         'workspace': str(tmpdir),
@@ -85,3 +87,551 @@ def test_empty_documents(tmpdir):
     docs2 = DocumentArray()
     indexer.search(docs2, {'top_k': TOP_K})
     assert len(docs2) == 0
+
+
+@pytest.mark.parametrize('metric', ['cosine', 'euclidean', 'inner_product'])
+def test_prepared_index(tmpdir, metric):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(dump_path=dump_path, runtime_args=runtime, metric=metric, is_distance=True)
+    assert indexer._index_operand.dtype == np.float32
+    assert indexer._index_operand.shape == (7, len(indexer._ids))
+
+    query = np.random.random(7)
+    docs = DocumentArray([Document(embedding=query)])
+    indexer.search(docs, {'top_k': TOP_K})
+
+    vecs = np.array(indexer._vecs)
+    if metric == 'cosine':
+        expected = 1 - (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).dot(query / np.linalg.norm(query))
+    elif metric == 'euclidean':
+        # the distance between the normalized vectors, as computed before the operand was prepared
+        expected = np.linalg.norm(
+            vecs / np.linalg.norm(vecs, axis=1, keepdims=True) - query / np.linalg.norm(query), axis=1
+        )
+    else:
+        expected = 1 - vecs.dot(query)
+    expected_ids = indexer._ids[np.argsort(expected)[:TOP_K]]
+    assert [m.id for m in docs[0].matches] == list(expected_ids)
+    np.testing.assert_allclose(
+        [m.scores[metric].value for m in docs[0].matches], np.sort(expected)[:TOP_K], rtol=1e-4, atol=1e-5
+    )
+
+
+def test_prepared_index_follows_metric(tmpdir):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    query = np.random.random(7)
+    for metric in ['inner_product', 'euclidean', 'cosine', 'inner_product']:
+        # every restart on the same workspace prepares the operand of its own metric
+        indexer = NumpySearcher(dump_path=dump_path, runtime_args=runtime, metric=metric)
+        fresh = NumpySearcher(dump_path=dump_path, runtime_args=runtime, metric=metric, mmap=False)
+        assert _search_ids(indexer, query) == _search_ids(fresh, query)
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 4, 100])
+@pytest.mark.parametrize('query_batch_size', [None, 1, 2])
+def test_blocked_search(tmpdir, block_size, query_batch_size):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(dump_path=dump_path, runtime_args=runtime)
+    blocked_indexer = NumpySearcher(
+        dump_path=dump_path,
+        runtime_args=runtime,
+        block_size=block_size,
+        query_batch_size=query_batch_size,
+    )
+    queries = np.random.random((3, 7))
+    docs = DocumentArray([Document(embedding=q) for q in queries])
+    blocked_docs = DocumentArray([Document(embedding=q) for q in queries])
+    indexer.search(docs, {'top_k': TOP_K})
+    blocked_indexer.search(blocked_docs, {'top_k': TOP_K})
+
+    for doc, blocked_doc in zip(docs, blocked_docs):
+        assert len(blocked_doc.matches) == TOP_K
+        assert [m.id for m in doc.matches] == [m.id for m in blocked_doc.matches]
+
+
+def test_mmap_reuses_materialized_dump(tmpdir):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(dump_path=dump_path, runtime_args=runtime)
+    assert isinstance(indexer._vecs, np.memmap)
+    assert isinstance(indexer._index_operand, np.memmap)
+    vecs_path = indexer._vecs.filename
+    mtime = os.stat(vecs_path).st_mtime_ns
+
+    reloaded = NumpySearcher(dump_path=dump_path, runtime_args=runtime)
+    assert reloaded._vecs.filename == vecs_path
+    assert os.stat(vecs_path).st_mtime_ns == mtime
+    np.testing.assert_equal(reloaded._ids, indexer._ids)
+    np.testing.assert_equal(reloaded._vecs, indexer._vecs)
+
+    in_memory = NumpySearcher(dump_path=dump_path, runtime_args=runtime, mmap=False)
+    assert not isinstance(in_memory._vecs, np.memmap)
+    np.testing.assert_equal(in_memory._vecs, indexer._vecs)
+
+
+def test_mmap_without_workspace():
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(dump_path=dump_path, runtime_args={'pea_id': 0})
+    assert not isinstance(indexer._vecs, np.memmap)
+    query = DocumentArray([Document(embedding=np.random.random([7]))])
+    indexer.search(query, {})
+    assert len(query[0].matches) == 5
+
+
+def test_mmap_rematerializes_changed_dump(tmpdir):
+    runtime = {
+        'workspace': os.path.join(str(tmpdir), 'workspace'),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(str(tmpdir), 'dump')
+    shutil.copytree(os.path.join(cur_dir, 'dump1'), dump_path)
+    indexer = NumpySearcher(dump_path=dump_path, runtime_args=runtime)
+    assert len(indexer._ids) == 10
+
+    shutil.rmtree(dump_path)
+    shutil.copytree(os.path.join(cur_dir, 'dump_empty'), dump_path)
+    reloaded = NumpySearcher(dump_path=dump_path, runtime_args=runtime)
+    assert len(reloaded._ids) == 0
+
+
+@pytest.fixture()
+def quantizable_dump(tmpdir):
+    np.random.seed(0)
+    vecs = np.random.random((500, 16))
+    keys = np.arange(len(vecs)).astype(str)
+    dump_path = os.path.join(str(tmpdir), 'dump')
+    export_dump_streaming(
+        dump_path,
+        1,
+        len(keys),
+        zip(keys, vecs, [b'' for _ in range(len(vecs))]),
+    )
+    return dump_path
+
+
+@pytest.mark.parametrize('quantization', ['float16', 'int8'])
+@pytest.mark.parametrize('metric', ['cosine', 'euclidean', 'inner_product'])
+@pytest.mark.parametrize('mmap', [True, False])
+@pytest.mark.parametrize('block_size', [None, 64])
+def test_quantization(tmpdir, quantizable_dump, quantization, metric, mmap, block_size):
+    runtime = {
+        'workspace': os.path.join(str(tmpdir), 'workspace'),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    indexer = NumpySearcher(
+        dump_path=quantizable_dump, runtime_args=runtime, metric=metric, mmap=mmap, is_distance=True
+    )
+    quantized_indexer = NumpySearcher(
+        dump_path=quantizable_dump,
+        runtime_args=runtime,
+        metric=metric,
+        mmap=mmap,
+        is_distance=True,
+        quantization=quantization,
+        rescore_factor=4,
+        block_size=block_size,
+    )
+    assert quantized_indexer._index_operand.dtype == np.dtype(quantization)
+    assert indexer._index_operand.dtype == np.float32
+
+    queries = np.random.random((3, 16))
+    # the quantized scan approximates the exact distances of every document
+    q_emb = indexer._prepare_queries(queries)
+    num_docs = len(indexer._ids)
+    positions, dists = indexer._scan(q_emb, num_docs)
+    quantized_positions, quantized_dists = quantized_indexer._scan(q_emb, num_docs)
+    np.testing.assert_allclose(
+        np.take_along_axis(quantized_dists, np.argsort(quantized_positions, axis=1), axis=1),
+        np.take_along_axis(dists, np.argsort(positions, axis=1), axis=1),
+        atol=2e-2,
+    )
+
+    docs = DocumentArray([Document(embedding=q) for q in queries])
+    quantized_docs = DocumentArray([Document(embedding=q) for q in queries])
+    indexer.search(docs, {'top_k': TOP_K})
+    quantized_indexer.search(quantized_docs, {'top_k': TOP_K})
+
+    for doc, quantized_doc in zip(docs, quantized_docs):
+        # only 4 * TOP_K of the 500 documents are rescored
+        assert [m.id for m in doc.matches] == [m.id for m in quantized_doc.matches]
+        np.testing.assert_allclose(
+            [m.scores[metric].value for m in doc.matches],
+            [m.scores[metric].value for m in quantized_doc.matches],
+            rtol=1e-5,
+        )
+
+
+def test_quantization_invalid(tmpdir):
+    with pytest.raises(ValueError):
+        NumpySearcher(runtime_args={'workspace': str(tmpdir), 'pea_id': 0}, quantization='int4')
+
+
+@pytest.mark.parametrize('num_workers', [2, 3])
+@pytest.mark.parametrize('block_size', [None, 2])
+def test_parallel_search(tmpdir, num_workers, block_size):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(dump_path=dump_path, runtime_args=runtime)
+    parallel_indexer = NumpySearcher(
+        dump_path=dump_path,
+        runtime_args=runtime,
+        num_workers=num_workers,
+        block_size=block_size,
+    )
+    queries = np.random.random((3, 7))
+    docs = DocumentArray([Document(embedding=q) for q in queries])
+    parallel_docs = DocumentArray([Document(embedding=q) for q in queries])
+    indexer.search(docs, {'top_k': TOP_K})
+    parallel_indexer.search(parallel_docs, {'top_k': TOP_K})
+    parallel_indexer.close()
+
+    for doc, parallel_doc in zip(docs, parallel_docs):
+        assert [m.id for m in doc.matches] == [m.id for m in parallel_doc.matches]
+
+
+# most of the signal is in the first dimensions, as with Matryoshka embeddings
+DIM_WEIGHTS = np.array([1.0] * 8 + [0.01] * 24)
+
+
+@pytest.fixture()
+def reducible_dump(tmpdir):
+    np.random.seed(0)
+    vecs = np.random.random((200, 32)) * DIM_WEIGHTS
+    keys = np.arange(len(vecs)).astype(str)
+    dump_path = os.path.join(str(tmpdir), 'dump')
+    export_dump_streaming(
+        dump_path,
+        1,
+        len(keys),
+        zip(keys, vecs, [b'' for _ in range(len(vecs))]),
+    )
+    return dump_path
+
+
+@pytest.mark.parametrize('reduction', ['pca', 'prefix'])
+@pytest.mark.parametrize('metric', ['cosine', 'euclidean', 'inner_product'])
+def test_reduced_dimension(tmpdir, reducible_dump, reduction, metric):
+    runtime = {
+        'workspace': os.path.join(str(tmpdir), 'workspace'),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    indexer = NumpySearcher(dump_path=reducible_dump, runtime_args=runtime, metric=metric, is_distance=True)
+    reduced_indexer = NumpySearcher(
+        dump_path=reducible_dump,
+        runtime_args=runtime,
+        metric=metric,
+        is_distance=True,
+        reduce_dim=8,
+        reduction=reduction,
+        rescore_factor=10,
+    )
+    assert reduced_indexer._index_operand.shape == (8, 200)
+
+    queries = np.random.random((5, 32)) * DIM_WEIGHTS
+    docs = DocumentArray([Document(embedding=q) for q in queries])
+    reduced_docs = DocumentArray([Document(embedding=q) for q in queries])
+    indexer.search(docs, {'top_k': TOP_K})
+    reduced_indexer.search(reduced_docs, {'top_k': TOP_K})
+
+    for doc, reduced_doc in zip(docs, reduced_docs):
+        assert len(reduced_doc.matches) == TOP_K
+        # the reranked matches carry exact scores
+        np.testing.assert_allclose(
+            [m.scores[metric].value for m in doc.matches],
+            [m.scores[metric].value for m in reduced_doc.matches],
+            rtol=1e-4,
+        )
+
+
+def test_reduced_dimension_projection_is_reused(tmpdir, reducible_dump):
+    runtime = {
+        'workspace': os.path.join(str(tmpdir), 'workspace'),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    indexer = NumpySearcher(dump_path=reducible_dump, runtime_args=runtime, reduce_dim=8)
+    projection_path = os.path.join(os.path.dirname(indexer._vecs.filename), 'projection.npy')
+    mtime = os.stat(projection_path).st_mtime_ns
+
+    reloaded = NumpySearcher(dump_path=reducible_dump, runtime_args=runtime, reduce_dim=8)
+    assert os.stat(projection_path).st_mtime_ns == mtime
+    np.testing.assert_equal(reloaded._projection, indexer._projection)
+
+
+def _search_ids(indexer, query, top_k=TOP_K):
+    docs = DocumentArray([Document(embedding=query)])
+    indexer.search(docs, {'top_k': top_k})
+    return [m.id for m in docs[0].matches]
+
+
+@pytest.mark.parametrize('quantization', [None, 'int8'])
+def test_index_update_delete(tmpdir, quantization):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(
+        dump_path=dump_path, runtime_args=runtime, metric='euclidean', quantization=quantization
+    )
+    assert indexer.size == 10
+    query = np.random.random(7)
+
+    indexer.index(DocumentArray([Document(id='new', embedding=query)]), {})
+    assert indexer.size == 11
+    assert _search_ids(indexer, query)[0] == 'new'
+
+    nearest = _search_ids(indexer, query)[1]
+    indexer.delete(DocumentArray([Document(id=nearest)]), {})
+    assert indexer.size == 10
+    assert nearest not in _search_ids(indexer, query, top_k=20)
+
+    indexer.update(DocumentArray([Document(id='new', embedding=-query)]), {})
+    assert indexer.size == 10
+    assert _search_ids(indexer, query)[0] != 'new'
+    assert _search_ids(indexer, -query)[0] == 'new'
+
+    # unknown ids are not inserted by an update
+    indexer.update(DocumentArray([Document(id='unknown', embedding=query)]), {})
+    assert indexer.size == 10
+
+    before = _search_ids(indexer, query, top_k=20)
+    indexer._compact()
+    assert indexer._delta_size == 0
+    assert indexer._num_deleted == 0
+    assert len(indexer._ids) == 10
+    assert _search_ids(indexer, query, top_k=20) == before
+
+
+@pytest.mark.parametrize('quantization', [None, 'int8'])
+def test_compaction_without_deletes(tmpdir, quantization):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(
+        dump_path=dump_path, runtime_args=runtime, quantization=quantization, compaction_threshold=5
+    )
+    reference = NumpySearcher(dump_path=dump_path, runtime_args=runtime, quantization=quantization)
+    vecs = np.random.random((12, 7))
+    queries = np.random.random((3, 7))
+    for i in range(0, 12, 6):
+        docs = DocumentArray([Document(id=f'new{j}', embedding=vecs[j]) for j in range(i, i + 6)])
+        indexer.index(docs, {})
+        reference.index(docs, {})
+        if indexer._compaction is not None:
+            indexer._compaction.join()
+        # the appended vectors are compacted into the tail, the memory-mapped index is untouched
+        assert isinstance(indexer._vecs, np.memmap)
+        assert isinstance(indexer._index_operand, np.memmap)
+        assert len(indexer._ids) == 10
+        assert indexer._tail_size == i + 6
+        for query in queries:
+            assert _search_ids(indexer, query) == _search_ids(reference, query)
+
+    indexer.delete(DocumentArray([Document(id='new0')]), {})
+    reference.delete(DocumentArray([Document(id='new0')]), {})
+    indexer._compact()
+    assert len(indexer._ids) == 21
+    assert indexer._tail_size == indexer._delta_size == 0
+    for query in queries:
+        assert _search_ids(indexer, query) == _search_ids(reference, query)
+
+
+@pytest.mark.parametrize('quantization', [None, 'int8'])
+def test_compaction_after_deleting_all(tmpdir, quantization):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(
+        dump_path=dump_path, runtime_args=runtime, quantization=quantization, compaction_threshold=5
+    )
+    indexer.delete(DocumentArray([Document(id=_id) for _id in indexer._ids]), {})
+    if indexer._compaction is not None:
+        indexer._compaction.join()
+    assert len(indexer._ids) == 0
+
+    vecs = np.random.random((6, 7))
+    indexer.index(DocumentArray([Document(id=str(j), embedding=vecs[j]) for j in range(6)]), {})
+    if indexer._compaction is not None:
+        indexer._compaction.join()
+    assert indexer._tail_size == 6
+    for j in range(6):
+        assert _search_ids(indexer, vecs[j])[0] == str(j)
+
+
+def test_index_update_wrong_dimension(tmpdir):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    indexer = NumpySearcher(dump_path=os.path.join(cur_dir, 'dump1'), runtime_args=runtime)
+    _id = indexer._ids[0]
+    for endpoint in (indexer.update, indexer.index):
+        with pytest.raises(ValueError):
+            endpoint(DocumentArray([Document(id=_id, embedding=np.random.random(3))]), {})
+        # the indexed document is left as it was
+        assert indexer.size == 10
+        assert indexer._position_of(_id) == 0
+
+
+def test_index_without_dump(tmpdir):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    indexer = NumpySearcher(runtime_args=runtime, compaction_threshold=20)
+    vecs = np.random.random((30, 7))
+    for i in range(0, 30, 10):
+        indexer.index(DocumentArray([Document(id=str(j), embedding=vecs[j]) for j in range(i, i + 10)]), {})
+    if indexer._compaction is not None:
+        indexer._compaction.join()
+    assert indexer.size == 30
+    assert len(indexer._ids) + indexer._delta_size == 30
+    for j in (0, 15, 29):
+        assert _search_ids(indexer, vecs[j])[0] == str(j)
+
+    indexer.delete(DocumentArray([Document(id=str(j)) for j in range(30)]), {})
+    indexer._compact()
+    assert indexer.size == 0
+    docs = DocumentArray([Document(embedding=vecs[0])])
+    indexer.search(docs, {})
+    assert len(docs[0].matches) == 0
+
+
+def _search_filtered(indexer, query, filter, top_k=TOP_K):
+    docs = DocumentArray([Document(embedding=query)])
+    indexer.search(docs, {'top_k': top_k, 'filter': filter})
+    return [m.id for m in docs[0].matches]
+
+
+@pytest.mark.parametrize('filter_gather_threshold', [0, 1])
+@pytest.mark.parametrize('quantization', [None, 'int8'])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_filtered_search(tmpdir, filter_gather_threshold, quantization, mmap):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(
+        dump_path=dump_path,
+        runtime_args=runtime,
+        metric='euclidean',
+        quantization=quantization,
+        mmap=mmap,
+        filter_tags=['field'],
+        filter_gather_threshold=filter_gather_threshold,
+    )
+    query = np.random.random(7)
+    ranking = _search_ids(indexer, query, top_k=10)
+
+    allowlist = ['2', '5', '7']
+    expected = [_id for _id in ranking if _id in allowlist]
+    assert _search_filtered(indexer, query, {'ids': allowlist}) == expected
+    assert _search_filtered(indexer, query, {'ids': allowlist}, top_k=2) == expected[:2]
+
+    assert _search_filtered(indexer, query, {'tags': {'field': 'tag data 3'}}) == ['3']
+    tags = {'field': ['tag data 3', 'tag data 5']}
+    assert sorted(_search_filtered(indexer, query, {'tags': tags})) == ['3', '5']
+    assert _search_filtered(indexer, query, {'ids': ['2', '3'], 'tags': tags}) == ['3']
+    assert _search_filtered(indexer, query, {'tags': {'unknown': 'value'}}) == []
+
+    indexer.delete(DocumentArray([Document(id='5')]), {})
+    indexer.index(
+        DocumentArray([Document(id='new', embedding=query, tags={'field': 'tag data 5'})]), {}
+    )
+    assert _search_filtered(indexer, query, {'tags': tags}) == ['new', '3']
+    assert _search_filtered(indexer, query, {'ids': allowlist}) == [
+        _id for _id in expected if _id != '5'
+    ]
+
+    indexer._compact()
+    assert _search_filtered(indexer, query, {'tags': tags}) == ['new', '3']
+
+
+def test_query_cache(tmpdir):
+    runtime = {
+        'workspace': str(tmpdir),
+        'name': 'searcher',
+        'pea_id': 0,
+        'replica_id': 0,
+    }
+    dump_path = os.path.join(cur_dir, 'dump1')
+    indexer = NumpySearcher(dump_path=dump_path, runtime_args=runtime, cache_size=2)
+    queries = np.random.random((3, 7))
+
+    first = _search_ids(indexer, queries[0])
+    assert _search_ids(indexer, queries[0]) == first
+    assert indexer.cache_info == {'hits': 1, 'misses': 1, 'size': 1, 'max_size': 2}
+
+    # top_k and the filter are part of the key
+    assert _search_ids(indexer, queries[0], top_k=2) == first[:2]
+    assert _search_filtered(indexer, queries[0], {'ids': first[1:]}) == first[1:]
+    assert indexer.cache_info['misses'] == 3
+    assert indexer.cache_info['size'] == 2
+
+    docs = DocumentArray([Document(embedding=q) for q in queries])
+    indexer.search(docs, {})
+    assert indexer.cache_info['hits'] == 1
+    indexer.search(docs, {})
+    assert indexer.cache_info['hits'] == 3
+    assert indexer.cache_info['size'] == 2
+    docs = DocumentArray([Document()])
+    indexer.report_cache_info(docs, {})
+    assert docs[0].tags['cache_info'] == indexer.cache_info
+
+    # any change of the index empties the cache
+    indexer.index(DocumentArray([Document(id='new', embedding=queries[0])]), {})
+    assert indexer.cache_info['size'] == 0
+    assert _search_ids(indexer, queries[0])[0] == 'new'